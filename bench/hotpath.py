@@ -0,0 +1,56 @@
+"""Накладные расходы статических помощников на одно сообщение: до и после предсборки.
+
+    python bench/hotpath.py [ITERATIONS]
+
+"before" повторяет прежние реализации (t() с двумя поисками и запасным словарём,
+клавиатуры и системный промпт, собираемые на каждый вызов), "after" — текущие из main.py.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+os.environ["STATE_BACKEND"] = "memory"
+
+import main  # noqa: E402
+from telebot import types  # noqa: E402
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+PERSONA = main.PERSONAS[0]
+
+def old_t(lang, key):
+    return main.I18N.get(lang, main.I18N["en"]).get(key, key)
+
+def old_donate_markup(lang):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton(old_t(lang, "donate_btn"), url=main.DONATE_URL))
+    return markup.to_json()  # telebot сериализует разметку при каждой отправке
+
+def old_status(lang, mode):
+    labels = main.I18N[lang]["modes_labels"]
+    return old_t(lang, "status").format(mode=labels.get(mode, mode))
+
+# (название, до, после, сколько раз на обычное сообщение)
+CASES = [
+    ("t()", lambda: old_t("tr", "corrections"), lambda: main.t("tr", "corrections"), 4),
+    ("system prompt", lambda: main.build_system_prompt("chat", "tr", PERSONA),
+     lambda: main.system_prompt("chat", "tr", PERSONA), 2),
+    ("language keyboard", lambda: main.build_language_keyboard().to_json(), lambda: main.LANGUAGE_KEYBOARD, 0),
+    ("donate markup", lambda: old_donate_markup("tr"), lambda: main.DONATE_MARKUPS["tr"], 1 / main.DONATE_REMINDER_EVERY),
+    ("status text", lambda: old_status("tr", "chat"), lambda: main.STATUS_TEXTS[("tr", "chat")], 0),
+]
+
+def per_call(fn) -> float:
+    return min(timeit.repeat(fn, number=N, repeat=5)) / N * 1e6
+
+if __name__ == "__main__":
+    total_before = total_after = 0.0
+    print(f"{'helper':20} {'before, µs':>11} {'after, µs':>10}")
+    for name, before, after, per_message in CASES:
+        b, a = per_call(before), per_call(after)
+        total_before += b * per_message
+        total_after += a * per_message
+        print(f"{name:20} {b:11.3f} {a:10.3f}")
+    print(f"{'per text message':20} {total_before:11.3f} {total_after:10.3f}")
@@ -0,0 +1,291 @@
+"""Нагрузочный тест без сети: main.py против локальных заглушек Bot API и OpenAI.
+
+    python bench/loadtest.py --rate 5 --messages 300 --voice-share 0.3 --seed 1
+
+Заглушки поднимаются в этом же процессе на 127.0.0.1 (TELEGRAM_API_URL и
+OPENAI_BASE_URL указывают на них). Задержки ответов — логнормальные с заданной
+медианой и sigma (`--chat-latency 0.8:0.4` и т.д.), генераторы случайных чисел
+засеяны `--seed`, апдейты приходят с постоянным темпом `--rate` в секунду.
+Задержка сообщения — от передачи апдейта боту до конца обработчика (включая
+отправку ответа и озвучки через исходящую очередь). Ошибкой считается ответ
+пользователю с текстом err_text / err_voice / rate_limited.
+
+Входные данные и задержки повторяются от запуска к запуску; остаётся шум
+планировщика asyncio и деградации под нагрузкой (пропуск follow-up и озвучки),
+поэтому сравнивайте несколько прогонов, а не один.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+TOKEN = "123456:loadtest"
+REPLIES = [
+    "Ich bin heute sehr müde, weil ich schlecht geschlafen habe. Und du? Korrekturen: 'bin' statt 'habe'.",
+    "Das klingt gut! Wir können morgen zusammen ins Kino gehen.",
+    "Gestern habe ich einen langen Spaziergang im Park gemacht. Es war wunderschön.",
+    "Kein Problem. Sag mir einfach Bescheid, wenn du Hilfe brauchst.",
+]
+TRANSCRIPTS = [
+    "Ich habe gestern einen Film gesehen",
+    "Wie sagt man apple auf Deutsch",
+    "Heute ist das Wetter schön",
+]
+FAKE_OGG = b"OggS" + bytes(16 * 1024)
+
+def parse_latency(spec: str):
+    median, sigma = spec.split(":")
+    return float(median), float(sigma)
+
+def bind() -> socket.socket:
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+class Latency:
+    def __init__(self, spec, rnd: random.Random):
+        self.median, self.sigma = spec
+        self.rnd = rnd
+
+    def sample(self) -> float:
+        return self.rnd.lognormvariate(math.log(self.median), self.sigma) if self.median > 0 else 0.0
+
+class FakeOpenAI:
+    def __init__(self, args):
+        self.chat = Latency(args.chat_latency, random.Random(args.seed * 31 + 1))
+        self.stt = Latency(args.stt_latency, random.Random(args.seed * 31 + 2))
+        self.tts = Latency(args.tts_latency, random.Random(args.seed * 31 + 3))
+        self.rnd = random.Random(args.seed * 31 + 4)
+        self.error_rate = args.openai_error_rate
+        self.requests = 0
+
+    def failed(self):
+        self.requests += 1
+        if self.rnd.random() < self.error_rate:
+            return web.json_response({"error": {"message": "injected", "type": "server_error"}}, status=500)
+        return None
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        if (error := self.failed()) is not None:
+            return error
+        system = body["messages"][0]["content"]
+        if "Ответь только" in system:
+            text = "Нет"
+        elif "Rückfrage" in system:
+            text = "Und was machst du am Wochenende?"
+        else:
+            text = self.rnd.choice(REPLIES)
+        usage = {"prompt_tokens": 400, "completion_tokens": len(text) // 4, "total_tokens": 400 + len(text) // 4}
+        delay = self.chat.sample()
+        base = {"id": "chatcmpl-load", "created": int(time.time()), "model": body["model"]}
+        if not body.get("stream"):
+            await asyncio.sleep(delay)
+            return web.json_response({
+                **base, "object": "chat.completion", "usage": usage,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            })
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        parts = [text[i:i + 12] for i in range(0, len(text), 12)]
+        await asyncio.sleep(delay * 0.3)  # время до первого токена
+        for part in parts:
+            chunk = {**base, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": part}, "finish_reason": None}]}
+            await resp.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(delay * 0.7 / len(parts))
+        final = {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+        await resp.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+        return resp
+
+    async def transcriptions(self, request):
+        await request.read()
+        if (error := self.failed()) is not None:
+            return error
+        await asyncio.sleep(self.stt.sample())
+        return web.json_response({"text": self.rnd.choice(TRANSCRIPTS)})
+
+    async def speech(self, request):
+        await request.json()
+        if (error := self.failed()) is not None:
+            return error
+        await asyncio.sleep(self.tts.sample())
+        return web.Response(body=FAKE_OGG, content_type="audio/ogg")
+
+    async def models(self, request):
+        return web.json_response({"object": "list", "data": [{"id": "gpt-4o-mini", "object": "model"}]})
+
+    def app(self):
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_get("/v1/models", self.models)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/audio/transcriptions", self.transcriptions)
+        app.router.add_post("/v1/audio/speech", self.speech)
+        return app
+
+class FakeBotApi:
+    def __init__(self, args):
+        self.latency = Latency(args.tg_latency, random.Random(args.seed * 31 + 5))
+        self.next_id = 0
+        self.texts = []  # (chat_id, text) всего, что бот отправил пользователям
+        self.calls = 0
+
+    def message(self, chat_id, **extra):
+        self.next_id += 1
+        return {"message_id": self.next_id, "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"}, **extra}
+
+    async def method(self, request):
+        self.calls += 1
+        name = request.match_info["method"]
+        params = dict(request.query)
+        if request.can_read_body:
+            # telebot шлёт параметры формой даже в GET (getFile)
+            if request.method == "POST":
+                form = (await request.post()).items()
+            else:
+                form = parse_qsl((await request.read()).decode())
+            params.update({k: v for k, v in form if isinstance(v, str)})
+        await asyncio.sleep(self.latency.sample())
+        chat_id = params.get("chat_id", 0)
+        if name in ("sendMessage", "editMessageText"):
+            self.texts.append((int(chat_id), params.get("text", "")))
+            result = self.message(chat_id, text=params.get("text", ""))
+        elif name == "sendVoice":
+            result = self.message(chat_id, voice={"file_id": f"v{self.next_id}", "file_unique_id": f"u{self.next_id}",
+                                                  "duration": 3})
+        elif name == "sendAudio":
+            result = self.message(chat_id, audio={"file_id": f"a{self.next_id}", "file_unique_id": f"u{self.next_id}",
+                                                  "duration": 3})
+        elif name == "getFile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(FAKE_OGG),
+                      "file_path": f"voice/{file_id}.ogg"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def file(self, request):
+        await asyncio.sleep(self.latency.sample())
+        return web.Response(body=FAKE_OGG, content_type="audio/ogg")
+
+    def app(self):
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.file)
+        return app
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def make_update(n: int, user_id: int, voice: bool, rnd: random.Random) -> dict:
+    message = {
+        "message_id": n, "date": int(time.time()),
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        "chat": {"id": user_id, "type": "private"},
+    }
+    if voice:
+        message["voice"] = {"file_id": f"in{n}", "file_unique_id": f"in{n}", "duration": 4}
+    else:
+        message["text"] = rnd.choice(TRANSCRIPTS) + f" ({n})"
+    return {"update_id": n, "message": message}
+
+async def run(args, main, openai_sock, tg_sock):
+    fake_openai, fake_tg = FakeOpenAI(args), FakeBotApi(args)
+    runners = []
+    for app, sock in ((fake_openai.app(), openai_sock), (fake_tg.app(), tg_sock)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.SockSite(runner, sock).start()
+        runners.append(runner)
+
+    error_texts = {main.t(lang, key) for lang in main.LANGS for key in ("err_text", "err_voice", "rate_limited")}
+    rnd = random.Random(args.seed)
+    latencies = []
+
+    async def one(n: int):
+        user_id = 1000 + rnd.randrange(args.users)
+        update = main.types.Update.de_json(make_update(n, user_id, rnd.random() < args.voice_share, rnd))
+        started = time.monotonic()
+        await main.bot.process_new_updates([update])
+        latencies.append(time.monotonic() - started)
+
+    tasks = []
+    started = time.monotonic()
+    for n in range(args.messages):
+        await asyncio.sleep(max(0.0, started + n / args.rate - time.monotonic()))
+        tasks.append(asyncio.create_task(one(n + 1)))
+    await asyncio.gather(*tasks)
+    wall = time.monotonic() - started
+
+    errors = sum(1 for _, text in fake_tg.texts if text in error_texts)
+    report = {
+        "messages": args.messages,
+        "target_rate": args.rate,
+        "throughput": round(args.messages / wall, 2),
+        "p50": round(percentile(latencies, 0.50), 3),
+        "p95": round(percentile(latencies, 0.95), 3),
+        "p99": round(percentile(latencies, 0.99), 3),
+        "error_rate": round(errors / args.messages, 4),
+        "openai_requests": fake_openai.requests,
+        "telegram_calls": fake_tg.calls,
+    }
+    await main.bot.close_session()
+    for runner in runners:
+        await runner.cleanup()
+    return report
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=5, help="апдейтов в секунду")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--users", type=int, default=100, help="сколько разных пользователей пишут")
+    parser.add_argument("--voice-share", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--chat-latency", type=parse_latency, default="0.8:0.4", help="медиана:sigma, сек")
+    parser.add_argument("--stt-latency", type=parse_latency, default="0.6:0.3")
+    parser.add_argument("--tts-latency", type=parse_latency, default="0.7:0.3")
+    parser.add_argument("--tg-latency", type=parse_latency, default="0.05:0.5")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--json", action="store_true", help="вывести отчёт одной JSON-строкой")
+    args = parser.parse_args()
+
+    openai_sock, tg_sock = bind(), bind()
+    os.environ.update({
+        "BOT_TOKEN": TOKEN,
+        "OPENAI_API_KEY": "sk-loadtest",
+        "OPENAI_BASE_URL": "http://127.0.0.1:%d/v1" % openai_sock.getsockname()[1],
+        "TELEGRAM_API_URL": "http://127.0.0.1:%d" % tg_sock.getsockname()[1],
+        "STATE_BACKEND": "memory",
+        "TTS_CACHE_DIR": tempfile.mkdtemp(prefix="loadtest-tts-"),
+    })
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+    random.seed(args.seed)  # INITIATIVE_CHANCE и прочий random в main.py
+    import main
+
+    report = asyncio.run(run(args, main, openai_sock, tg_sock))
+    if args.json:
+        print(json.dumps(report))
+        return
+    print(f"{report['messages']} messages at {report['target_rate']}/s -> {report['throughput']}/s")
+    print(f"latency p50 {report['p50']}s  p95 {report['p95']}s  p99 {report['p99']}s")
+    print(f"errors {report['error_rate']:.2%}, OpenAI requests {report['openai_requests']}, "
+          f"Telegram calls {report['telegram_calls']}")
+    print(main.format_stage_stats())
+    print(main.format_route_stats())
+
+if __name__ == "__main__":
+    main_cli()
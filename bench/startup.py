@@ -0,0 +1,130 @@
+"""Холодный старт: стоимость импорта main и время от запуска процесса до первого ответа.
+
+    python bench/startup.py [RUNS]
+
+Импорт меряется в отдельном интерпретаторе. Для «пробуждения» бот запускается
+подпроцессом в webhook-режиме против заглушек Bot API и OpenAI из loadtest.py
+(с нулевыми задержками): сразу после старта шлём апдейт на вебхук, пока порт
+не начнёт принимать, и ждём первого sendMessage. Сравниваются FAST_START=0/1 и
+запуск `python main.py` против `python -m main` (код из __pycache__).
+"""
+import asyncio
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import aiohttp
+from aiohttp import web
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from loadtest import TOKEN, FakeBotApi, FakeOpenAI, bind, make_update  # noqa: E402
+
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+SECRET = "startup-bench"
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+
+def base_env(fast: bool) -> dict:
+    return {
+        **os.environ,
+        "BOT_TOKEN": TOKEN,
+        "OPENAI_API_KEY": "sk-startup",
+        "FAST_START": "1" if fast else "0",
+        "STATE_DB_PATH": os.path.join(tempfile.mkdtemp(prefix="startup-"), "state.db"),
+        "TTS_CACHE_DIR": tempfile.mkdtemp(prefix="startup-tts-"),
+    }
+
+def import_cost(fast: bool) -> float:
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET], cwd=REPO, env=base_env(fast),
+        capture_output=True, text=True, check=True,
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+async def wake_up(fast: bool, launcher: list, fake_tg: FakeBotApi, openai_port: int, tg_port: int) -> tuple:
+    sock = bind()
+    port = sock.getsockname()[1]
+    sock.close()
+    env = {
+        **base_env(fast),
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{tg_port}",
+        "WEBHOOK_URL": f"http://127.0.0.1:{port}",
+        "WEBHOOK_SECRET": SECRET,
+        "PORT": str(port),
+    }
+    fake_tg.texts.clear()
+    update = make_update(1, 4242, False, random.Random(1))
+    started = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, *launcher, cwd=REPO, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        async with aiohttp.ClientSession() as session:
+            while True:
+                try:
+                    async with session.post(
+                        f"http://127.0.0.1:{port}/telegram/webhook", json=update,
+                        headers={"X-Telegram-Bot-Api-Secret-Token": SECRET},
+                    ) as resp:
+                        if resp.status == 200:
+                            break
+                except aiohttp.ClientConnectionError:
+                    pass
+                if time.monotonic() - started > 30:
+                    raise TimeoutError("bot did not start listening")
+                await asyncio.sleep(0.002)
+        accepted = time.monotonic() - started
+        while not fake_tg.texts:
+            if time.monotonic() - started > 30:
+                raise TimeoutError("no reply")
+            await asyncio.sleep(0.002)
+        return accepted, time.monotonic() - started
+    finally:
+        proc.terminate()
+        await proc.wait()
+
+async def run_wake_ups():
+    args = SimpleNamespace(
+        seed=1, openai_error_rate=0.0,
+        chat_latency=(0, 0), stt_latency=(0, 0), tts_latency=(0, 0), tg_latency=(0, 0),
+    )
+    fake_openai, fake_tg = FakeOpenAI(args), FakeBotApi(args)
+    sockets = [bind(), bind()]
+    runners = []
+    for app, sock in zip((fake_openai.app(), fake_tg.app()), sockets):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.SockSite(runner, sock).start()
+        runners.append(runner)
+    openai_port, tg_port = (sock.getsockname()[1] for sock in sockets)
+
+    results = {}
+    for fast in (False, True):
+        for name, launcher in (("main.py", ["main.py"]), ("-m main", ["-m", "main"])):
+            samples = [await wake_up(fast, launcher, fake_tg, openai_port, tg_port) for _ in range(RUNS)]
+            results[(fast, name)] = (
+                statistics.median(s[0] for s in samples),
+                statistics.median(s[1] for s in samples),
+            )
+    for runner in runners:
+        await runner.cleanup()
+    return results
+
+if __name__ == "__main__":
+    subprocess.run([sys.executable, "-m", "compileall", "-q", "main.py"], cwd=REPO, check=True)
+    print(f"median of {RUNS} runs")
+    for fast in (False, True):
+        cost = statistics.median(import_cost(fast) for _ in range(RUNS))
+        print(f"import main, FAST_START={int(fast)}: {cost * 1000:7.0f} ms")
+    for (fast, name), (accepted, replied) in asyncio.run(run_wake_ups()).items():
+        print(f"wake-up FAST_START={int(fast)} {name:8}: webhook accepted {accepted * 1000:5.0f} ms, "
+              f"first reply {replied * 1000:5.0f} ms")
@@ -0,0 +1,83 @@
+"""Память под аналитику на 1M пользователей: старые структуры против текущих.
+
+    python bench/stats_memory.py [USERS] [DAYS]
+
+Каждый пользователь пишет 2 сообщения в случайные дни из последних DAYS.
+"before" повторяет прежний bump_stats (dict с datetime на пользователя и set
+user_id на каждый день), "after" — текущий из main.py.
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+os.environ["STATE_BACKEND"] = "memory"
+
+import main  # noqa: E402
+
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+DAYS = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+MESSAGES_PER_USER = 2
+
+def workload():
+    rnd = random.Random(42)
+    base = datetime.now(timezone.utc)
+    for user_id in range(USERS):
+        uid = 10**9 + user_id * 7
+        for _ in range(MESSAGES_PER_USER):
+            yield uid, rnd.choice(("text", "voice")), base - timedelta(days=rnd.randrange(DAYS))
+
+def before():
+    user_stats = {}
+    daily_messages = defaultdict(int)
+    daily_unique = defaultdict(set)
+    for user_id, kind, now in workload():
+        d = now.strftime("%Y-%m-%d")
+        st = user_stats.get(user_id)
+        if not st:
+            st = {"total": 0, "text": 0, "voice": 0, "first": now, "last": now}
+            user_stats[user_id] = st
+        st["total"] += 1
+        st[kind] += 1
+        st["last"] = now
+        daily_messages[d] += 1
+        daily_unique[d].add(user_id)
+    # прежний /stats: суммирование по всем пользователям
+    started = time.perf_counter()
+    sum(s["total"] for s in user_stats.values())
+    sum(s["text"] for s in user_stats.values())
+    sum(s["voice"] for s in user_stats.values())
+    [len(daily_unique.get(d, set())) for d in list(daily_unique)[:7]]
+    return (user_stats, daily_messages, daily_unique), time.perf_counter() - started
+
+def after():
+    # все дни workload не позже сегодняшнего — ротация сработает один раз
+    main.rollover_stats(datetime.now(timezone.utc).date())
+    for user_id, kind, now in workload():
+        main.bump_stats(user_id, kind, now)
+    main.state.dirty.clear()  # между сбросами в бэкенд это живёт секунды
+    started = time.perf_counter()
+    main.format_admin_stats()
+    return (main.user_stats, main.daily_messages, main.daily_unique), time.perf_counter() - started
+
+def measure(name, fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    data, stats_time = fn()
+    elapsed = time.perf_counter() - started
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:6}: {current / 2**20:8.1f} MiB, fill {elapsed:6.1f}s, /stats {stats_time * 1000:7.1f} ms")
+    return data
+
+if __name__ == "__main__":
+    print(f"{USERS} users, {DAYS} days, {USERS * MESSAGES_PER_USER} messages")
+    data = measure("before", before)
+    del data
+    measure("after", after)
@@ -1,12 +1,36 @@
 import os
+import re
+import base64
+import json
+import math
 import random
+import asyncio
+import contextlib
+import contextvars
+import aiohttp
+import functools
+import hashlib
+import hmac
+import importlib
+import ipaddress
+import secrets
+import shutil
+import signal
+import string
+import sys
+import unicodedata
+import sqlite3
+import tempfile
+import threading
+import time
 import traceback
-import requests
-import telebot
-from telebot import types
-from datetime import datetime, timezone
-from openai import OpenAI
-from collections import defaultdict
+from aiohttp import web
+from telebot import asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict, defaultdict, deque
+from difflib import SequenceMatcher
+from types import MappingProxyType
 
 # === Env ===
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -24,8 +48,673 @@ DONATE_REMINDER_EVERY = 15
 user_msg_count = {}
 
 # === Clients ===
-bot = telebot.TeleBot(BOT_TOKEN)
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Свой адрес Bot API: локальный telegram-bot-api сервер или заглушка из bench/loadtest.py.
+# OpenAI-клиент так же читает OPENAI_BASE_URL сам.
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+asyncio_helper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+
+# Быстрый старт для scale-to-zero: openai (~0.6 с импорта) не грузим при старте —
+# клиент создаётся при первом обращении, а импорт прогревается в фоне (warm_up).
+FAST_START = os.getenv("FAST_START", "1") == "1"
+
+def make_openai_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)  # повторы — в openai_call
+
+class Lazy:
+    """Прокси, который создаёт объект при первом обращении к его атрибутам."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.target = None
+
+    def get(self):
+        if self.target is None:
+            self.target = self.factory()
+        return self.target
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+bot = AsyncTeleBot(BOT_TOKEN)
+client = Lazy(make_openai_client) if FAST_START else make_openai_client()
+
+# === Метрики ===
+# Минимальная реализация формата Prometheus без внешних зависимостей:
+# счётчики, гауги и гистограммы с метками; отдаются на /metrics.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+def _fmt_labels(key: tuple, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self.values = defaultdict(float)
+        METRICS.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        self.values[_labels(labels)] += amount
+
+    def lines(self):
+        for key, value in self.values.items():
+            yield f"{self.name}{_fmt_labels(key)} {value}"
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[_labels(labels)] = value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.values = {}  # метки -> [счётчики по корзинам..., сумма, количество]
+        METRICS.append(self)
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        row = self.values.get(key)
+        if row is None:
+            row = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                row[i] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def quantile(self, q: float, **labels):
+        # оценка по верхней границе корзины — для /stats этого достаточно
+        row = self.values.get(_labels(labels))
+        if not row or not row[-1]:
+            return None
+        rank = q * row[-1]
+        for i, bound in enumerate(self.buckets):
+            if row[i] >= rank:
+                return bound
+        return float("inf")
+
+    def lines(self):
+        for key, row in self.values.items():
+            for i, bound in enumerate(self.buckets):
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{_fmt_labels(key, le)} {row[i]}"
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_fmt_labels(key, le)} {row[-1]}"
+            yield f"{self.name}_sum{_fmt_labels(key)} {row[-2]}"
+            yield f"{self.name}_count{_fmt_labels(key)} {row[-1]}"
+
+METRICS = []
+
+STAGE_SECONDS = Histogram("bot_stage_seconds", "Latency of pipeline stages")
+UPDATE_SECONDS = Histogram("bot_update_seconds", "End-to-end handling time of an update by handler")
+OPENAI_SECONDS = Histogram("bot_openai_request_seconds", "OpenAI request latency by model")
+OPENAI_REQUESTS = Counter("bot_openai_requests_total", "OpenAI requests by model and outcome")
+OPENAI_TOKENS = Counter("bot_openai_tokens_total", "OpenAI tokens by model and kind")
+ACTIVE_UPDATES = Gauge("bot_active_updates", "Updates currently being handled")
+COLLECTED = Gauge("bot_internal", "Counters collected from caches, queues and breakers")
+
+@contextlib.contextmanager
+def timed(stage: str):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.monotonic() - started, stage=stage)
+
+def count_tokens(model: str, usage):
+    if usage is None:
+        return
+    OPENAI_TOKENS.inc(getattr(usage, "prompt_tokens", 0) or 0, model=model, kind="prompt")
+    OPENAI_TOKENS.inc(getattr(usage, "completion_tokens", 0) or 0, model=model, kind="completion")
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is not None:
+        OPENAI_TOKENS.inc(getattr(details, "cached_tokens", 0) or 0, model=model, kind="cached")
+
+def collect_internal():
+    # значения, которые и так считаются в своих объектах, — снимаем в момент запроса
+    values = {
+        "tts_cache_file_id_hits": tts_cache.file_id_hits,
+        "tts_cache_disk_hits": tts_cache.hits,
+        "tts_cache_misses": tts_cache.misses,
+        "translation_cache_hits": translation_cache.hits,
+        "translation_cache_near_hits": translation_cache.near_hits,
+        "translation_cache_misses": translation_cache.misses,
+        "detector_local_yes": detector_stats["local_yes"],
+        "detector_local_no": detector_stats["local_no"],
+        "detector_escalated": detector_stats["escalated"],
+        "http_conns_new": http_stats["new"],
+        "http_conns_reused": http_stats["reused"],
+        "openai_queue_depth": scheduler.depth(),
+        "openai_queue_rejected": scheduler.stats["rejected"],
+        "outbox_sent": outbox.sent,
+        "webhook_queue_depth": update_queue.qsize(),
+        "single_flight_shared_replies": reply_flight.shared,
+        "single_flight_shared_tts": tts_flight.shared,
+        "transcript_cache_hits": transcript_cache.hits,
+        "transcript_cache_misses": transcript_cache.misses,
+        "voice_rejected": voice_stats["rejected"],
+        "voice_truncated": voice_stats["truncated"],
+        "voice_trimmed_bytes_saved": voice_stats["bytes_in"] - voice_stats["bytes_out"],
+    }
+    for name, breaker in breakers.items():
+        values[f"breaker_{name}_trips"] = breaker.trips
+        values[f"breaker_{name}_retries"] = breaker.retries
+    for name, value in values.items():
+        COLLECTED.set(value, name=name)
+
+def render_metrics() -> str:
+    collect_internal()
+    out = []
+    for metric in METRICS:
+        out.append(f"# HELP {metric.name} {metric.help}")
+        out.append(f"# TYPE {metric.name} {metric.kind}")
+        out.extend(metric.lines())
+    return "\n".join(out) + "\n"
+
+def format_stage_stats() -> str:
+    lines = []
+    for key, row in STAGE_SECONDS.values.items():
+        stage = dict(key)["stage"]
+        p50 = STAGE_SECONDS.quantile(0.5, stage=stage)
+        p95 = STAGE_SECONDS.quantile(0.95, stage=stage)
+        lines.append(f"  {stage}: avg {row[-2] / row[-1]:.2f}s, p50≤{p50}s, p95≤{p95}s (n={row[-1]})")
+    for key, row in OPENAI_SECONDS.values.items():
+        model = dict(key)["model"]
+        tokens = sum(v for k, v in OPENAI_TOKENS.values.items() if dict(k)["model"] == model)
+        lines.append(f"  {model}: {row[-1]} calls, avg {row[-2] / row[-1]:.2f}s, {tokens:.0f} tokens")
+    return "⏱ Stages / models:\n" + ("\n".join(sorted(lines)) if lines else "  no data yet")
+
+# === HTTP-пул для Telegram ===
+# Одна aiohttp-сессия с keep-alive на весь трафик к api.telegram.org: и Bot API, и скачивание файлов.
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "50"))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "60"))
+
+http_stats = {"new": 0, "reused": 0, "queued": 0}
+
+async def _on_conn_create(session, ctx, params):
+    http_stats["new"] += 1
+
+async def _on_conn_reuse(session, ctx, params):
+    http_stats["reused"] += 1
+
+async def _on_conn_queued(session, ctx, params):
+    http_stats["queued"] += 1
+
+class PooledSessionManager(asyncio_helper.SessionManager):
+    async def create_session(self):
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(_on_conn_create)
+        trace.on_connection_reuseconn.append(_on_conn_reuse)
+        trace.on_connection_queued_start.append(_on_conn_queued)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_POOL_SIZE,
+                limit_per_host=HTTP_POOL_PER_HOST,
+                keepalive_timeout=HTTP_KEEPALIVE,
+                ttl_dns_cache=300,
+                ssl=self.ssl_context,
+            ),
+            trace_configs=[trace],
+        )
+        return self.session
+
+asyncio_helper.session_manager = PooledSessionManager()
+
+# === Параллельная обработка апдейтов ===
+# Каждый апдейт обрабатывается отдельной asyncio-задачей; семафор ограничивает,
+# сколько апдейтов одновременно ждут OpenAI/Telegram.
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "100"))
+update_slots = asyncio.Semaphore(MAX_CONCURRENT_UPDATES)
+
+def with_update_slot(handler):
+    @functools.wraps(handler)
+    async def wrapper(update, *args, **kwargs):
+        current_user.set(update.from_user.id)
+        async with update_slots:
+            ACTIVE_UPDATES.inc()
+            started = time.monotonic()
+            try:
+                return await handler(update, *args, **kwargs)
+            finally:
+                ACTIVE_UPDATES.inc(-1)
+                UPDATE_SECONDS.observe(time.monotonic() - started, handler=handler.__name__)
+    return wrapper
+
+# === Планировщик запросов к OpenAI ===
+# Перед каждым вызовом client.* берём токен из корзины пользователя и из общей корзины.
+# Очереди пользователей обслуживаются по кругу, так что один активный пользователь
+# не может выесть общий лимит. Пользователь берётся из contextvar, который ставит
+# with_update_slot: задачи asyncio наследуют его автоматически.
+OPENAI_GLOBAL_RPM = float(os.getenv("OPENAI_GLOBAL_RPM", "500"))
+OPENAI_USER_RPM = float(os.getenv("OPENAI_USER_RPM", "20"))
+OPENAI_USER_BURST = int(os.getenv("OPENAI_USER_BURST", "6"))
+OPENAI_USER_MAX_QUEUE = int(os.getenv("OPENAI_USER_MAX_QUEUE", "8"))
+DEGRADE_FOLLOWUP_DEPTH = int(os.getenv("DEGRADE_FOLLOWUP_DEPTH", "20"))  # глубже — без встречного вопроса
+DEGRADE_TTS_DEPTH = int(os.getenv("DEGRADE_TTS_DEPTH", "50"))            # глубже — без озвучки
+
+BUCKET_REAP_INTERVAL = 60  # сек между чистками корзин ушедших пользователей
+
+current_user = contextvars.ContextVar("current_user", default=0)
+
+class RateLimited(Exception):
+    pass
+
+class TokenBucket:
+    def __init__(self, rate_per_min: float, burst: float):
+        self.rate = rate_per_min / 60
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate > 0 else 1.0
+
+class FairScheduler:
+    def __init__(self):
+        self.global_bucket = TokenBucket(OPENAI_GLOBAL_RPM, max(1.0, OPENAI_GLOBAL_RPM / 60))
+        self.user_buckets = {}
+        self.queues = OrderedDict()  # user_id -> deque[(future, enqueued_at)], порядок = очередь обхода
+        self.wakeup = asyncio.Event()
+        self.runner = None
+        self.reaped_at = time.monotonic()
+        self.stats = {"granted": 0, "rejected": 0, "wait_total": 0.0, "wait_max": 0.0,
+                      "skipped_followups": 0, "skipped_tts": 0}
+
+    def depth(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    async def acquire(self):
+        user_id = current_user.get()
+        queue = self.queues.get(user_id)
+        if queue is None:
+            queue = self.queues[user_id] = deque()
+        if len(queue) >= OPENAI_USER_MAX_QUEUE:
+            self.stats["rejected"] += 1
+            raise RateLimited(user_id)
+        fut = asyncio.get_running_loop().create_future()
+        queue.append((fut, time.monotonic()))
+        if self.runner is None or self.runner.done():
+            self.runner = asyncio.create_task(self.run())
+        self.wakeup.set()
+        await fut
+
+    def bucket(self, user_id) -> TokenBucket:
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            bucket = self.user_buckets[user_id] = TokenBucket(OPENAI_USER_RPM, OPENAI_USER_BURST)
+        return bucket
+
+    def dispatch(self):
+        # Один проход по кругу: не больше одного запроса на пользователя.
+        # Возвращает, через сколько секунд пробовать снова (None — ждать новых запросов).
+        now = time.monotonic()
+        self.global_bucket.refill(now)
+        delay = None
+        granted = False
+        for user_id in list(self.queues):
+            queue = self.queues[user_id]
+            while queue and queue[0][0].done():  # запрос отменён, пока ждал
+                queue.popleft()
+            if not queue:
+                del self.queues[user_id]
+                continue
+            if self.global_bucket.tokens < 1:
+                return self.global_bucket.wait_time()
+            bucket = self.bucket(user_id)
+            bucket.refill(now)
+            if bucket.tokens < 1:
+                wait = bucket.wait_time()
+                delay = wait if delay is None else min(delay, wait)
+                continue
+            bucket.tokens -= 1
+            self.global_bucket.tokens -= 1
+            fut, enqueued = queue.popleft()
+            fut.set_result(None)
+            waited = now - enqueued
+            self.stats["granted"] += 1
+            self.stats["wait_total"] += waited
+            self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+            granted = True
+            if queue:
+                self.queues.move_to_end(user_id)
+            else:
+                del self.queues[user_id]
+        if granted and self.queues:
+            return 0
+        return delay
+
+    def reap(self, now: float):
+        # корзины без очереди, успевшие восстановиться, ничего не помнят — удаляем
+        for user_id, bucket in list(self.user_buckets.items()):
+            if user_id in self.queues:
+                continue
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.user_buckets[user_id]
+        self.reaped_at = now
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            if now - self.reaped_at >= BUCKET_REAP_INTERVAL:
+                self.reap(now)
+            delay = self.dispatch()
+            if delay is None:
+                if not self.user_buckets:
+                    await self.wakeup.wait()
+                    continue
+                delay = BUCKET_REAP_INTERVAL
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def should_skip_followup(self) -> bool:
+        if self.depth() >= DEGRADE_FOLLOWUP_DEPTH:
+            self.stats["skipped_followups"] += 1
+            return True
+        return False
+
+    def should_skip_tts(self) -> bool:
+        if self.depth() >= DEGRADE_TTS_DEPTH:
+            self.stats["skipped_tts"] += 1
+            return True
+        return False
+
+    def format_stats(self) -> str:
+        st = self.stats
+        avg = st["wait_total"] / st["granted"] if st["granted"] else 0.0
+        return (
+            f"• OpenAI queue: depth {self.depth()}, avg wait {avg:.2f}s, max {st['wait_max']:.2f}s, "
+            f"rejected {st['rejected']}, degraded: follow-up {st['skipped_followups']}, TTS {st['skipped_tts']}"
+        )
+
+scheduler = FairScheduler()
+
+# === Повторы, backoff и circuit breaker ===
+# Все вызовы client.* идут через openai_call, все вызовы bot.* — через tg (telegram_call).
+# Временные ошибки (429, 5xx, обрывы соединения, таймауты) повторяются с экспоненциальной
+# задержкой и джиттером, Retry-After соблюдается; на весь вызов есть общий дедлайн.
+# Если провайдер падает подряд, breaker размыкается и вызовы сразу падают до конца паузы.
+# 429 — это лимит (у Telegram — на конкретный чат), а не сбой провайдера: его повторяем,
+# но в breaker не засчитываем, иначе flood-ответы одного чата закроют отправку всем.
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+OPENAI_DEADLINE = float(os.getenv("OPENAI_DEADLINE", "60"))
+TELEGRAM_DEADLINE = float(os.getenv("TELEGRAM_DEADLINE", "30"))
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+
+class CircuitOpen(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self.rejected = 0
+        self.retries = 0
+
+    def before(self):
+        if self.opened_at is not None and time.monotonic() - self.opened_at < BREAKER_COOLDOWN:
+            self.rejected += 1
+            raise CircuitOpen(self.name)
+        # после паузы пропускаем запросы (half-open): первый же сбой снова разомкнёт цепь
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= BREAKER_THRESHOLD:
+            if self.opened_at is None:
+                self.trips += 1
+            self.opened_at = time.monotonic()
+
+    def format_stats(self) -> str:
+        state = "open" if self.opened_at is not None and time.monotonic() - self.opened_at < BREAKER_COOLDOWN else "closed"
+        return f"{self.name}: {state}, retries {self.retries}, trips {self.trips}, fast-failed {self.rejected}"
+
+breakers = {"openai": CircuitBreaker("openai"), "telegram": CircuitBreaker("telegram")}
+
+def backoff_delay(attempt: int) -> float:
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+def openai_retry_after(e: Exception):
+    # None — ошибка не временная; иначе — сколько ждать (0 — решит backoff)
+    openai = sys.modules.get("openai")  # клиент ленивый: пока модуль не загружен, его ошибок быть не может
+    if isinstance(e, asyncio.TimeoutError) or (openai is not None and isinstance(e, openai.APIConnectionError)):
+        return 0.0
+    if openai is not None and isinstance(e, openai.APIStatusError):
+        if e.status_code not in (408, 409, 429) and e.status_code < 500:
+            return None
+        headers = e.response.headers
+        try:
+            if "retry-after-ms" in headers:
+                return float(headers["retry-after-ms"]) / 1000
+            return float(headers.get("retry-after", 0))
+        except ValueError:
+            return 0.0
+    return None
+
+def telegram_retry_after(e: Exception):
+    if isinstance(e, (asyncio.TimeoutError, aiohttp.ClientConnectionError, asyncio_helper.RequestTimeout)):
+        return 0.0
+    if isinstance(e, asyncio_helper.ApiTelegramException):
+        if e.error_code == 429:
+            return float((e.result_json.get("parameters") or {}).get("retry_after", 1))
+        return 0.0 if e.error_code >= 500 else None
+    if isinstance(e, asyncio_helper.ApiHTTPException):
+        return 0.0 if getattr(e.result, "status", 0) >= 500 else None
+    return None
+
+def rate_limited(e: Exception) -> bool:
+    return getattr(e, "status_code", None) == 429 or getattr(e, "error_code", None) == 429
+
+async def call_with_retry(breaker: CircuitBreaker, retry_after, deadline: float, fn, args, kwargs, before_attempt=None):
+    end = time.monotonic() + deadline
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        breaker.before()
+        if before_attempt is not None:
+            await before_attempt()
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            raise asyncio.TimeoutError(f"{breaker.name}: deadline exceeded")
+        try:
+            result = await asyncio.wait_for(fn(*args, **kwargs), remaining)
+        except Exception as e:
+            wait = retry_after(e)
+            if wait is None:
+                raise
+            if not rate_limited(e):
+                breaker.failure()
+            delay = wait if wait > 0 else backoff_delay(attempt)
+            if attempt == RETRY_MAX_ATTEMPTS - 1 or time.monotonic() + delay >= end:
+                raise
+            breaker.retries += 1
+            await asyncio.sleep(delay)
+        else:
+            breaker.success()
+            return result
+
+async def openai_call(fn, *args, deadline: float = OPENAI_DEADLINE, **kwargs):
+    # токен планировщика берём на каждую попытку: повтор — тоже запрос к OpenAI
+    model = kwargs.get("model", "unknown")
+    started = time.monotonic()
+    try:
+        result = await call_with_retry(
+            breakers["openai"], openai_retry_after, deadline, fn, args, kwargs, before_attempt=scheduler.acquire
+        )
+    except Exception as e:
+        OPENAI_REQUESTS.inc(model=model, outcome=type(e).__name__)
+        raise
+    OPENAI_REQUESTS.inc(model=model, outcome="ok")
+    OPENAI_SECONDS.observe(time.monotonic() - started, model=model)
+    count_tokens(model, getattr(result, "usage", None))
+    return result
+
+async def telegram_call(fn, *args, **kwargs):
+    return await call_with_retry(breakers["telegram"], telegram_retry_after, TELEGRAM_DEADLINE, fn, args, kwargs)
+
+# === Исходящая очередь ===
+# Всё, что бот пишет в чат (send_*, edit_message_text), идёт через очередь этого чата:
+# порядок сообщений сохраняется, а темп держится в пределах лимитов Telegram —
+# ~30 сообщений/с на бота и ~1 сообщение/с в чат (с небольшим всплеском).
+# Ответ 429 с retry_after обрабатывает telegram_call — очередь чата просто ждёт.
+OUTBOX_GLOBAL_PER_SEC = float(os.getenv("OUTBOX_GLOBAL_PER_SEC", "30"))
+OUTBOX_CHAT_PER_SEC = float(os.getenv("OUTBOX_CHAT_PER_SEC", "1"))
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", "3"))
+PACED_METHODS = {"send_message": 0, "send_voice": 0, "send_audio": 0, "edit_message_text": 1}  # индекс chat_id
+
+class Outbox:
+    def __init__(self):
+        self.global_bucket = TokenBucket(OUTBOX_GLOBAL_PER_SEC * 60, OUTBOX_GLOBAL_PER_SEC)
+        self.chats = {}  # chat_id -> (deque отправок, TokenBucket)
+        self.workers = {}
+        self.sent = 0
+        self.paced = 0.0
+
+    async def submit(self, chat_id, fn, args, kwargs):
+        fut = asyncio.get_running_loop().create_future()
+        if chat_id not in self.chats:
+            self.chats[chat_id] = (deque(), TokenBucket(OUTBOX_CHAT_PER_SEC * 60, OUTBOX_CHAT_BURST))
+        self.chats[chat_id][0].append((fut, fn, args, kwargs))
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self.drain(chat_id))
+        return await fut
+
+    async def take(self, bucket: TokenBucket):
+        while True:
+            bucket.refill(time.monotonic())
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return
+            wait = bucket.wait_time()
+            self.paced += wait
+            await asyncio.sleep(wait)
+
+    async def drain(self, chat_id):
+        queue, bucket = self.chats[chat_id]
+        try:
+            while queue:
+                fut, fn, args, kwargs = queue.popleft()
+                if fut.done():
+                    continue
+                await self.take(bucket)
+                await self.take(self.global_bucket)
+                try:
+                    result = await telegram_call(fn, *args, **kwargs)
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+                else:
+                    self.sent += 1
+                    if not fut.done():
+                        fut.set_result(result)
+        finally:
+            del self.workers[chat_id]
+            if queue:
+                self.workers[chat_id] = asyncio.create_task(self.drain(chat_id))
+            else:
+                self.reap(chat_id)
+
+    def reap(self, chat_id):
+        # корзину чата держим, пока она не восстановилась, иначе всплеск обойдёт лимит;
+        # потом удаляем запись, чтобы не копить по корзине на каждый когда-либо писавший чат
+        entry = self.chats.get(chat_id)
+        if entry is None or entry[0] or chat_id in self.workers:
+            return
+        bucket = entry[1]
+        bucket.refill(time.monotonic())
+        if bucket.tokens >= bucket.burst or bucket.rate <= 0:
+            del self.chats[chat_id]
+        else:
+            asyncio.get_running_loop().call_later((bucket.burst - bucket.tokens) / bucket.rate, self.reap, chat_id)
+
+    def format_stats(self) -> str:
+        pending = sum(len(q) for q, _ in self.chats.values())
+        return f"• Outbox: sent {self.sent}, pending {pending}, paced {self.paced:.1f}s total"
+
+outbox = Outbox()
+
+class Resilient:
+    """Прокси над bot: любой метод вызывается через telegram_call, отправки в чат — через outbox."""
+
+    def __init__(self, target):
+        self.target = target
+
+    def __getattr__(self, name):
+        method = getattr(self.target, name)
+        if name in PACED_METHODS:
+            pos = PACED_METHODS[name]
+
+            async def paced(*args, **kwargs):
+                chat_id = kwargs["chat_id"] if "chat_id" in kwargs else args[pos]
+                return await outbox.submit(chat_id, method, args, kwargs)
+            return paced
+        return functools.partial(telegram_call, method)
+
+tg = Resilient(bot)
+
+# === Single-flight ===
+# Одинаковые запросы, пришедшие одновременно (двойное нажатие, одна и та же фраза
+# от многих пользователей), ждут один общий вызов вместо того, чтобы повторять его.
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = {}
+        self.leaders = 0
+        self.shared = 0
+
+    async def do(self, key, fn, *args, **kwargs):
+        task = self.calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+            return await asyncio.shield(task)
+        self.shared += 1
+        try:
+            # shield: отмена одного ожидающего не должна отменять общий вызов для остальных
+            return await asyncio.shield(task)
+        except RateLimited:
+            # общий вызов идёт под лимитом того, кто его начал; его переполненная очередь
+            # не повод отказывать остальным — пробуем сами, под своим лимитом
+            return await fn(*args, **kwargs)
+
+    def format_stats(self) -> str:
+        return f"{self.name} {self.shared}/{self.leaders + self.shared} shared"
+
+def fingerprint(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+reply_flight = SingleFlight("replies")
+tts_flight = SingleFlight("TTS")
 
 # === Режимы ===
 # "teacher" | "chat" | "mix" | "auto"
@@ -37,6 +726,17 @@ def get_mode(user_id: int) -> str:
 
 def set_mode(user_id: int, mode: str):
     user_modes[user_id] = mode
+    state.mark("modes", user_id)
+
+# Ответ и исправления одним сообщением (по желанию пользователя)
+user_merge = {}
+
+def get_merge(user_id: int) -> bool:
+    return user_merge.get(user_id, False)
+
+def set_merge(user_id: int, merge: bool):
+    user_merge[user_id] = merge
+    state.mark("merge", user_id)
 
 # === Языки UI ===
 LANGS = ["ru", "uk", "en", "tr", "fa", "ar"]
@@ -57,6 +757,7 @@ def get_lang(user_id: int) -> str:
 def set_lang(user_id: int, lang: str):
     if lang in LANGS:
         user_langs[user_id] = lang
+        state.mark("langs", user_id)
 
 # === Персоны (личности) ===
 # Хранение выбранной персоны на пользователя
@@ -100,6 +801,9 @@ def get_persona(user_id: int) -> dict:
     if not persona:
         persona = pick_persona()
         user_personas[user_id] = persona
+        if shards.enabled:
+            shards.note_new_user(user_id)
+        state.mark("personas", user_id)
     return persona
 
 # Локализация строк
@@ -115,6 +819,7 @@ I18N = {
             "• /status — показать текущий режим\n"
             "• /language — сменить язык интерфейса\n"
             "• /donate — поддержать проект ☕\n"
+            "• /merge — ответ и исправления одним сообщением (вкл/выкл)\n"
             "• /stats — статистика бота (админ)\n\n"
             "Отправь текст или голосовое сообщение!"
         ),
@@ -122,6 +827,8 @@ I18N = {
         "mode_chat_on": "💬 Режим Собеседника включён.",
         "mode_mix_on": "🔀 Микс включён.",
         "mode_auto_on": "🤖 Авто-режим: исправляю только если ошибки есть.",
+        "merge_on": "📎 Исправления будут приходить вместе с ответом.",
+        "merge_off": "📎 Исправления будут приходить отдельным сообщением.",
         "status": "⚙️ Текущий режим: {mode}",
         "modes_labels": {"teacher": "Учитель", "chat": "Собеседник", "mix": "Микс", "auto": "Авто"},
         "donate_long": (
@@ -133,7 +840,9 @@ I18N = {
         "donate_btn": "☕ Поддержать проект",
         "admin_only": "Команда доступна только администратору.",
         "err_voice": "Произошла ошибка. Попробуй ещё раз.",
+        "voice_too_long": "🎙 Голосовое длиннее {limit} мин. Запиши, пожалуйста, покороче.",
         "err_text": "Извини, что-то пошло не так.",
+        "rate_limited": "⏳ Слишком много сообщений подряд. Подожди немного и попробуй снова.",
         "lang_choose": "🌐 Выбери язык интерфейса:",
         "lang_set": "✅ Язык интерфейса: {lang}",
         "corrections": "Исправления:",
@@ -150,6 +859,7 @@ I18N = {
             "• /status — показати поточний режим\n"
             "• /language — змінити мову інтерфейсу\n"
             "• /donate — підтримати проєкт ☕\n"
+            "• /merge — відповідь і виправлення одним повідомленням (увімк/вимк)\n"
             "• /stats — статистика бота (адмін)\n\n"
             "Надішли текст або голосове повідомлення!"
         ),
@@ -157,6 +867,8 @@ I18N = {
         "mode_chat_on": "💬 Режим Співрозмовника увімкнено.",
         "mode_mix_on": "🔀 Мікс увімкнено.",
         "mode_auto_on": "🤖 Авто-режим: виправляю лише якщо є помилки.",
+        "merge_on": "📎 Виправлення надходитимуть разом із відповіддю.",
+        "merge_off": "📎 Виправлення надходитимуть окремим повідомленням.",
         "status": "⚙️ Поточний режим: {mode}",
         "modes_labels": {"teacher": "Вчитель", "chat": "Співрозмовник", "mix": "Мікс", "auto": "Авто"},
         "donate_long": (
@@ -168,7 +880,9 @@ I18N = {
         "donate_btn": "☕ Підтримати проєкт",
         "admin_only": "Команда доступна лише адміністратору.",
         "err_voice": "Сталася помилка. Спробуй ще раз.",
+        "voice_too_long": "🎙 Голосове довше за {limit} хв. Запиши, будь ласка, коротше.",
         "err_text": "Вибач, щось пішло не так.",
+        "rate_limited": "⏳ Забагато повідомлень поспіль. Зачекай трохи й спробуй знову.",
         "lang_choose": "🌐 Оберіть мову інтерфейсу:",
         "lang_set": "✅ Мову встановлено: {lang}",
         "corrections": "Виправлення:",
@@ -185,6 +899,7 @@ I18N = {
             "• /status — show current mode\n"
             "• /language — change interface language\n"
             "• /donate — support the project ☕\n"
+            "• /merge — reply and corrections in one message (on/off)\n"
             "• /stats — bot stats (admin)\n\n"
             "Send me a text or a voice message!"
         ),
@@ -192,6 +907,8 @@ I18N = {
         "mode_chat_on": "💬 Chat mode enabled.",
         "mode_mix_on": "🔀 Mix mode enabled.",
         "mode_auto_on": "🤖 Auto mode: I correct only if there are mistakes.",
+        "merge_on": "📎 Corrections will come together with the reply.",
+        "merge_off": "📎 Corrections will come as a separate message.",
         "status": "⚙️ Current mode: {mode}",
         "modes_labels": {"teacher": "Teacher", "chat": "Chat", "mix": "Mix", "auto": "Auto"},
         "donate_long": (
@@ -203,7 +920,9 @@ I18N = {
         "donate_btn": "☕ Support the project",
         "admin_only": "This command is available to the administrator only.",
         "err_voice": "An error occurred. Please try again.",
+        "voice_too_long": "🎙 The voice message is longer than {limit} min. Please record a shorter one.",
         "err_text": "Sorry, something went wrong.",
+        "rate_limited": "⏳ Too many messages in a row. Please wait a moment and try again.",
         "lang_choose": "🌐 Choose your interface language:",
         "lang_set": "✅ Interface language: {lang}",
         "corrections": "Corrections:",
@@ -220,6 +939,7 @@ I18N = {
             "• /status — mevcut modu göster\n"
             "• /language — arayüz dilini değiştir\n"
             "• /donate — projeyi destekle ☕\n"
+            "• /merge — cevap ve düzeltmeler tek mesajda (aç/kapat)\n"
             "• /stats — bot istatistikleri (admin)\n\n"
             "Metin ya da sesli mesaj gönder!"
         ),
@@ -227,6 +947,8 @@ I18N = {
         "mode_chat_on": "💬 Sohbet modu etkin.",
         "mode_mix_on": "🔀 Karışık mod etkin.",
         "mode_auto_on": "🤖 Otomatik mod: Sadece hata varsa düzeltirim.",
+        "merge_on": "📎 Düzeltmeler cevapla birlikte gelecek.",
+        "merge_off": "📎 Düzeltmeler ayrı bir mesaj olarak gelecek.",
         "status": "⚙️ Mevcut mod: {mode}",
         "modes_labels": {"teacher": "Öğretmen", "chat": "Sohbet", "mix": "Karışık", "auto": "Otomatik"},
         "donate_long": (
@@ -238,7 +960,9 @@ I18N = {
         "donate_btn": "☕ Projeyi destekle",
         "admin_only": "Bu komut yalnızca yöneticiye özeldir.",
         "err_voice": "Bir hata oluştu. Lütfen tekrar dene.",
+        "voice_too_long": "🎙 Sesli mesaj {limit} dakikadan uzun. Lütfen daha kısa kaydet.",
         "err_text": "Üzgünüm, bir şeyler ters gitti.",
+        "rate_limited": "⏳ Arka arkaya çok fazla mesaj. Biraz bekle ve tekrar dene.",
         "lang_choose": "🌐 Arayüz dilini seç:",
         "lang_set": "✅ Arayüz dili: {lang}",
         "corrections": "Düzeltmeler:",
@@ -255,6 +979,7 @@ I18N = {
             "• /status — نمایش حالت فعلی\n"
             "• /language — تغییر زبان رابط\n"
             "• /donate — حمایت از پروژه ☕\n"
+            "• /merge — پاسخ و اصلاحات در یک پیام (روشن/خاموش)\n"
             "• /stats — آمار بات (ادمین)\n\n"
             "یک پیام متنی یا صوتی بفرست!"
         ),
@@ -262,6 +987,8 @@ I18N = {
         "mode_chat_on": "💬 حالت گفتگو فعال شد.",
         "mode_mix_on": "🔀 حالت ترکیبی فعال شد.",
         "mode_auto_on": "🤖 حالت خودکار: فقط در صورت وجود خطا تصحیح می‌کنم.",
+        "merge_on": "📎 اصلاحات همراه با پاسخ می‌آید.",
+        "merge_off": "📎 اصلاحات در پیام جداگانه می‌آید.",
         "status": "⚙️ حالت فعلی: {mode}",
         "modes_labels": {"teacher": "معلم", "chat": "گفتگو", "mix": "ترکیبی", "auto": "خودکار"},
         "donate_long": (
@@ -273,7 +1000,9 @@ I18N = {
         "donate_btn": "☕ حمایت از پروژه",
         "admin_only": "این دستور فقط برای ادمین در دسترس است.",
         "err_voice": "خطا رخ داد. دوباره تلاش کن.",
+        "voice_too_long": "🎙 پیام صوتی بیشتر از {limit} دقیقه است. لطفاً کوتاه‌تر ضبط کن.",
         "err_text": "متأسفم، مشکلی پیش آمد.",
+        "rate_limited": "⏳ پیام‌های زیادی پشت سر هم فرستادی. کمی صبر کن و دوباره تلاش کن.",
         "lang_choose": "🌐 زبان رابط را انتخاب کن:",
         "lang_set": "✅ زبان رابط: {lang}",
         "corrections": "اصلاحات:",
@@ -290,6 +1019,7 @@ I18N = {
             "• /status — عرض الوضع الحالي\n"
             "• /language — تغيير لغة الواجهة\n"
             "• /donate — دعم المشروع ☕\n"
+            "• /merge — الرد والتصحيحات في رسالة واحدة (تشغيل/إيقاف)\n"
             "• /stats — إحصاءات البوت (المشرف)\n\n"
             "أرسل رسالة نصية أو صوتية!"
         ),
@@ -297,6 +1027,8 @@ I18N = {
         "mode_chat_on": "💬 تم تفعيل وضع الدردشة.",
         "mode_mix_on": "🔀 تم تفعيل الوضع المختلط.",
         "mode_auto_on": "🤖 وضع تلقائي: أصحح فقط عند وجود أخطاء.",
+        "merge_on": "📎 ستصل التصحيحات مع الرد.",
+        "merge_off": "📎 ستصل التصحيحات في رسالة منفصلة.",
         "status": "⚙️ الوضع الحالي: {mode}",
         "modes_labels": {"teacher": "معلم", "chat": "دردشة", "mix": "مختلط", "auto": "تلقائي"},
         "donate_long": (
@@ -308,7 +1040,9 @@ I18N = {
         "donate_btn": "☕ دعم المشروع",
         "admin_only": "هذا الأمر متاح للمشرف فقط.",
         "err_voice": "حدث خطأ. حاول مرة أخرى.",
+        "voice_too_long": "🎙 الرسالة الصوتية أطول من {limit} دقيقة. سجّل رسالة أقصر من فضلك.",
         "err_text": "عذراً، حدث خطأ ما.",
+        "rate_limited": "⏳ رسائل كثيرة متتالية. انتظر قليلاً وحاول مرة أخرى.",
         "lang_choose": "🌐 اختر لغة الواجهة:",
         "lang_set": "✅ لغة الواجهة: {lang}",
         "corrections": "التصحيحات:",
@@ -316,8 +1050,39 @@ I18N = {
     },
 }
 
+def placeholders(text: str) -> set:
+    return {name for _, name, _, _ in string.Formatter().parse(text) if name is not None}
+
+def compile_i18n() -> dict:
+    # Каталог проверяется один раз при старте: у каждого языка те же ключи и те же
+    # подстановки {…}, что у английского. Словари обычные, а не MappingProxyType:
+    # t() вызывается на каждом сообщении, и прокси здесь заметно медленнее.
+    reference = I18N["en"]
+    problems = []
+    for lang in LANGS:
+        texts = I18N.get(lang, {})
+        missing, extra = reference.keys() - texts.keys(), texts.keys() - reference.keys()
+        if missing or extra:
+            problems.append(f"{lang}: missing {sorted(missing)}, extra {sorted(extra)}")
+        for key in reference.keys() & texts.keys():
+            text, ref = texts[key], reference[key]
+            if isinstance(ref, dict):  # подписи режимов и т.п.
+                if text.keys() != ref.keys():
+                    problems.append(f"{lang}.{key}: keys {sorted(text)}")
+            elif placeholders(text) != placeholders(ref):
+                problems.append(f"{lang}.{key}: placeholders {sorted(placeholders(text))}")
+    if problems:
+        raise RuntimeError("I18N catalog is inconsistent:\n" + "\n".join(problems))
+    return {
+        lang: {key: MappingProxyType(text) if isinstance(text, dict) else text for key, text in texts.items()}
+        for lang, texts in I18N.items()
+    }
+
+TEXTS = compile_i18n()
+TEXTS_EN = TEXTS["en"]
+
 def t(lang: str, key: str) -> str:
-    return I18N.get(lang, I18N["en"]).get(key, key)
+    return TEXTS.get(lang, TEXTS_EN).get(key, key)
 
 # === Простая аналитика ===
 def utcnow():
@@ -326,28 +1091,82 @@ def utcnow():
 def ymd(dt: datetime) -> str:
     return dt.strftime("%Y-%m-%d")
 
-user_stats = {}  # user_id -> dict
+# Итоги ведём бегущими счётчиками, чтобы /stats не обходил всех пользователей.
+# Уникальных за день считает HyperLogLog (4 КБ на день, ошибка ~1.6%);
+# дни старше STATS_RETENTION_DAYS удаляются при смене даты.
+STATS_RETENTION_DAYS = int(os.getenv("STATS_RETENTION_DAYS", "35"))
+HLL_PRECISION = 12  # 2^12 регистров по байту
+
+class HyperLogLog:
+    def __init__(self, registers: bytes = b""):
+        self.registers = bytearray(registers or 1 << HLL_PRECISION)
+
+    def add(self, user_id: int):
+        digest = hashlib.blake2b(user_id.to_bytes(8, "big", signed=True), digest_size=8).digest()
+        h = int.from_bytes(digest, "big")
+        idx = h >> (64 - HLL_PRECISION)
+        rest = h & ((1 << (64 - HLL_PRECISION)) - 1)
+        rank = 64 - HLL_PRECISION - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def __len__(self) -> int:
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # на малых числах точнее линейный подсчёт
+        return round(estimate)
+
+user_stats = {}  # user_id -> последний активный день (date.toordinal())
+stats_totals = defaultdict(int)  # "total" / "text" / "voice"
 daily_messages = defaultdict(int)
-daily_unique = defaultdict(set)
-
-def bump_stats(user_id: int, kind: str):
-    now = utcnow()
+daily_unique = defaultdict(HyperLogLog)
+stats_day = None  # дата последней ротации
+stats_day_ordinal = 0  # один объект int на день, общий для всех записей user_stats
+
+def register_user(user_id: int, day: int):
+    user_stats[user_id] = day
+    state.mark("user_stats", user_id)
+
+def rollover_stats(today):
+    global stats_day, stats_day_ordinal
+    stats_day = today
+    stats_day_ordinal = today.toordinal()
+    cutoff = ymd(today - timedelta(days=STATS_RETENTION_DAYS))
+    for table, days in (("daily_messages", daily_messages), ("daily_unique", daily_unique)):
+        for d in [d for d in days if d < cutoff]:
+            del days[d]
+            state.mark(table, d)  # удалится из бэкенда при сбросе
+
+def bump_stats(user_id: int, kind: str, now: datetime = None):
+    now = now or utcnow()
+    today = now.date()
+    if stats_day is None or today > stats_day:
+        rollover_stats(today)
     d = ymd(now)
-    st = user_stats.get(user_id)
-    if not st:
-        st = {"total": 0, "text": 0, "voice": 0, "first": now, "last": now}
-        user_stats[user_id] = st
-    st["total"] += 1
-    st[kind] += 1
-    st["last"] = now
+    day = stats_day_ordinal if today == stats_day else today.toordinal()
+    if user_stats.get(user_id) != day:
+        # запись пользователя меняется раз в день, а не на каждое сообщение
+        register_user(user_id, day)
+    stats_totals["total"] += 1
+    stats_totals[kind] += 1
     daily_messages[d] += 1
     daily_unique[d].add(user_id)
+    state.mark("stats_totals", "total")
+    state.mark("stats_totals", kind)
+    state.mark("daily_messages", d)
+    state.mark("daily_unique", d)
 
 def format_admin_stats(days: int = 7) -> str:
     total_users = len(user_stats)
-    total_msgs = sum(s["total"] for s in user_stats.values())
-    text_msgs = sum(s["text"] for s in user_stats.values())
-    voice_msgs = sum(s["voice"] for s in user_stats.values())
+    total_msgs = stats_totals.get("total", 0)
+    text_msgs = stats_totals.get("text", 0)
+    voice_msgs = stats_totals.get("voice", 0)
 
     lines = []
     today = utcnow().date()
@@ -355,84 +1174,733 @@ def format_admin_stats(days: int = 7) -> str:
         day = today.fromordinal(today.toordinal() - i)
         key = day.strftime("%Y-%m-%d")
         msgs = daily_messages.get(key, 0)
-        uniq = len(daily_unique.get(key, set()))
-        lines.append(f"{key}: {msgs} msgs, {uniq} users")
+        uniq = len(daily_unique[key]) if key in daily_unique else 0
+        lines.append(f"{key}: {msgs} msgs, ~{uniq} users")
     lines = "\n".join(lines)
 
+    local = detector_stats["local_yes"] + detector_stats["local_no"]
+    checked = local + detector_stats["escalated"]
+    saved = f"{100 * local / checked:.0f}%" if checked else "—"
+
     return (
         "📈 Bot stats\n"
         f"• Users total: {total_users}\n"
-        f"• Messages total: {total_msgs} (text: {text_msgs}, voice: {voice_msgs})\n\n"
+        f"• Messages total: {total_msgs} (text: {text_msgs}, voice: {voice_msgs})\n"
+        f"• Detector: local yes {detector_stats['local_yes']}, local no {detector_stats['local_no']}, "
+        f"LLM {detector_stats['escalated']} (saved {saved})\n"
+        f"• TTS cache: file_id {tts_cache.file_id_hits}, disk {tts_cache.hits}, synth {tts_cache.misses}\n"
+        f"• Telegram HTTP: new conns {http_stats['new']}, reused {http_stats['reused']}, "
+        f"waited for pool {http_stats['queued']}\n"
+        f"{format_prompt_cache_stats()}\n"
+        f"{format_route_stats()}\n"
+        f"• Translation cache: exact {translation_cache.hits}, near {translation_cache.near_hits}, "
+        f"miss {translation_cache.misses}\n"
+        f"{scheduler.format_stats()}\n"
+        f"• Single-flight: {reply_flight.format_stats()}, {tts_flight.format_stats()}\n"
+        f"{outbox.format_stats()}\n"
+        f"• Breakers: {breakers['openai'].format_stats()}; {breakers['telegram'].format_stats()}\n"
+        f"{shards.format_stats()}\n"
+        f"{format_voice_stats()}\n\n"
+        f"{format_stage_stats()}\n\n"
         f"🗓 Last {days} days:\n{lines}"
     )
 
+# === Хранилище состояния ===
+# Словари выше — горячий кэш: чтения идут только из памяти. Изменённые ключи помечаются
+# через state.mark() и раз в STATE_FLUSH_INTERVAL секунд пачкой сбрасываются в бэкенд.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "state.db")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "5"))
+
+legacy_totals = defaultdict(int)  # счётчики из записей старого формата, см. migrate_stats()
+
+def _decode_user(value) -> int:
+    if isinstance(value, dict):
+        # старый формат: {"total", "text", "voice", "first", "last"} с датами в ISO
+        for kind in ("total", "text", "voice"):
+            legacy_totals[kind] += value.get(kind, 0)
+        return datetime.fromisoformat(value["last"]).toordinal()
+    return value
+
+def _decode_unique(value) -> HyperLogLog:
+    if isinstance(value, list):  # старый формат: список user_id
+        hll = HyperLogLog()
+        for user_id in value:
+            hll.add(user_id)
+        return hll
+    return HyperLogLog(base64.b64decode(value))
+
+def migrate_stats():
+    # после загрузки: переносим итоги из записей старого формата и чистим старые дни
+    if legacy_totals and not stats_totals:
+        stats_totals.update(legacy_totals)
+        for table, target in (("stats_totals", stats_totals), ("user_stats", user_stats)):
+            for key in target:
+                state.mark(table, key)
+        for d in daily_unique:
+            state.mark("daily_unique", d)
+    legacy_totals.clear()
+    rollover_stats(utcnow().date())
+
+PERSONAS_BY_ID = {p["id"]: p for p in PERSONAS}
+
+# таблица -> (словарь, тип ключа, encode, decode)
+STATE_TABLES = {
+    "modes": (user_modes, int, str, str),
+    "langs": (user_langs, int, str, str),
+    "merge": (user_merge, int, bool, bool),
+    "personas": (user_personas, int, lambda p: p["id"], PERSONAS_BY_ID.__getitem__),
+    "msg_count": (user_msg_count, int, int, int),
+    "user_stats": (user_stats, int, int, _decode_user),
+    "stats_totals": (stats_totals, str, int, int),
+    "daily_messages": (daily_messages, str, int, int),
+    "daily_unique": (daily_unique, str, lambda h: base64.b64encode(h.registers).decode(), _decode_unique),
+}
+
+class MemoryBackend:
+    def __init__(self):
+        self.rows = defaultdict(dict)
+
+    def load(self) -> dict:
+        return {table: dict(rows) for table, rows in self.rows.items()}
+
+    def save(self, batch: dict):
+        for table, rows in batch.items():
+            for key, value in rows.items():
+                if value is None:
+                    self.rows[table].pop(key, None)
+                else:
+                    self.rows[table][key] = value
+
+class SqliteBackend:
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (tbl TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (tbl, key))"
+        )
+        self.conn.commit()
+
+    def load(self) -> dict:
+        data = defaultdict(dict)
+        with self.lock:
+            for tbl, key, value in self.conn.execute("SELECT tbl, key, value FROM kv"):
+                data[tbl][key] = value
+        return data
+
+    def save(self, batch: dict):
+        items = [(tbl, key, value) for tbl, rows in batch.items() for key, value in rows.items()]
+        upserts = [row for row in items if row[2] is not None]
+        deletes = [(tbl, key) for tbl, key, value in items if value is None]
+        with self.lock, self.conn:  # одна транзакция на пачку: либо вся, либо ничего
+            self.conn.executemany("INSERT OR REPLACE INTO kv (tbl, key, value) VALUES (?, ?, ?)", upserts)
+            self.conn.executemany("DELETE FROM kv WHERE tbl = ? AND key = ?", deletes)
+
+STATE_BACKENDS = {
+    "sqlite": lambda: SqliteBackend(STATE_DB_PATH),
+    "memory": MemoryBackend,
+}
+
+class StateStore:
+    def __init__(self, backend, interval: float):
+        self.backend = backend
+        self.interval = interval
+        self.dirty = defaultdict(set)
+        self.lock = asyncio.Lock()
+        self.flushes = 0
+
+    def mark(self, table: str, key):
+        self.dirty[table].add(key)
+
+    def load(self):
+        loaded = skipped = 0
+        for table, rows in self.backend.load().items():
+            if table not in STATE_TABLES:
+                continue
+            target, key_type, _, decode = STATE_TABLES[table]
+            for key, value in rows.items():
+                try:
+                    target[key_type(key)] = decode(json.loads(value))
+                    loaded += 1
+                except Exception:
+                    # битая строка не должна мешать старту
+                    skipped += 1
+        print(f"💾 State loaded: {loaded} rows, skipped {skipped}")
+
+    def snapshot(self) -> dict:
+        dirty, self.dirty = self.dirty, defaultdict(set)
+        batch = {}
+        for table, keys in dirty.items():
+            target, _, encode, _ = STATE_TABLES[table]
+            # None — ключ удалён из словаря, бэкенд удалит строку
+            batch[table] = {
+                str(key): json.dumps(encode(target[key]), ensure_ascii=False) if key in target else None
+                for key in keys
+            }
+        return batch
+
+    async def flush(self):
+        async with self.lock:
+            batch = self.snapshot()
+            if not batch:
+                return
+            try:
+                await asyncio.to_thread(self.backend.save, batch)
+                self.flushes += 1
+            except Exception:
+                traceback.print_exc()
+                for table, rows in batch.items():
+                    key_type = STATE_TABLES[table][1]
+                    for key in rows:
+                        self.mark(table, key_type(key))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+state = StateStore(STATE_BACKENDS[STATE_BACKEND](), STATE_FLUSH_INTERVAL)
+
 # === Donate helpers ===
-def send_donate_message(chat_id: int, lang: str, short: bool = False):
-    text = t(lang, "donate_short") if short else t(lang, "donate_long")
+def build_donate_markup(lang: str):
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton(t(lang, "donate_btn"), url=DONATE_URL))
-    bot.send_message(chat_id, text, reply_markup=markup, disable_web_page_preview=True)
+    return markup
 
-def inc_and_maybe_remind(chat_id: int, user_id: int):
+# Разметка статична — сериализуем один раз; telebot передаёт JSON-строку как есть
+DONATE_MARKUPS = MappingProxyType({lang: build_donate_markup(lang).to_json() for lang in LANGS})
+
+async def send_donate_message(chat_id: int, lang: str, short: bool = False):
+    text = t(lang, "donate_short") if short else t(lang, "donate_long")
+    markup = DONATE_MARKUPS.get(lang) or DONATE_MARKUPS[DEFAULT_LANG]
+    await tg.send_message(chat_id, text, reply_markup=markup, disable_web_page_preview=True)
+
+async def inc_and_maybe_remind(chat_id: int, user_id: int):
     cnt = user_msg_count.get(user_id, 0) + 1
     user_msg_count[user_id] = cnt
+    state.mark("msg_count", user_id)
     if DONATE_REMINDER_EVERY and cnt % DONATE_REMINDER_EVERY == 0:
-        send_donate_message(chat_id, get_lang(user_id), short=True)
+        await send_donate_message(chat_id, get_lang(user_id), short=True)
 
 # === TTS (OGG + fallback MP3) ===
-def send_tts(chat_id: int, text: str, base: str = "reply", voice: str = "alloy"):
-    try:
-        ogg_path = f"{base}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.ogg"
-        with client.audio.speech.with_streaming_response.create(
+# Ответ режем по предложениям: первое озвучиваем отдельно и шлём сразу,
+# остальное синтезируется параллельно. Аудио держим в памяти, без файлов.
+TTS_CHUNKING = os.getenv("TTS_CHUNKING", "1") == "1"
+TTS_MIN_TAIL = 40  # короткий хвост не отделяем — лишний voice хуже пары секунд ожидания
+RE_SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+
+# Кэш синтеза: ключ — хэш (нормализованный текст, голос, формат).
+# Рядом с аудио храним file_id из Telegram, чтобы повторно не загружать файл.
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_MB", "200")) * 1024 * 1024
+
+class TtsCache:
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> размер аудио, от старых к свежим
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.file_id_hits = 0
+        if max_bytes > 0:
+            os.makedirs(path, exist_ok=True)
+            self.load()
+
+    def load(self):
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(".audio"):
+                full = os.path.join(self.path, name)
+                st = os.stat(full)
+                files.append((st.st_mtime, name[:-len(".audio")], st.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total += size
+        self.remove(self.evict())  # при старте, до цикла событий
+
+    @staticmethod
+    def key(text: str, voice: str, response_format: str) -> str:
+        norm = " ".join(unicodedata.normalize("NFC", text).split())
+        return hashlib.sha256(f"{voice}\0{response_format}\0{norm}".encode()).hexdigest()
+
+    def file(self, key: str, ext: str) -> str:
+        return os.path.join(self.path, f"{key}.{ext}")
+
+    # Чтение и запись файлов — в потоке (asyncio.to_thread), учёт в entries — в цикле событий.
+    def read(self, key: str) -> bytes:
+        path = self.file(key, "audio")
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)
+        return data
+
+    def write(self, key: str, data: bytes):
+        tmp = self.file(key, "tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.file(key, "audio"))
+
+    def read_file_id(self, key: str) -> str:
+        with open(self.file(key, "fid"), encoding="utf-8") as f:
+            return f.read().strip()
+
+    def write_file_id(self, key: str, file_id: str):
+        with open(self.file(key, "fid"), "w", encoding="utf-8") as f:
+            f.write(file_id)
+
+    def remove(self, keys, exts=("audio", "fid")):
+        for key in keys:
+            for ext in exts:
+                try:
+                    os.remove(self.file(key, ext))
+                except OSError:
+                    pass
+
+    async def get(self, key: str):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        try:
+            data = await asyncio.to_thread(self.read, key)
+        except OSError:
+            self.drop(key)
+            await asyncio.to_thread(self.remove, [key])
+            self.misses += 1
+            return None
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    async def put(self, key: str, data: bytes):
+        if self.max_bytes <= 0 or len(data) > self.max_bytes:
+            return
+        await asyncio.to_thread(self.write, key, data)
+        self.total += len(data) - self.entries.pop(key, 0)
+        self.entries[key] = len(data)
+        evicted = self.evict()
+        if evicted:
+            await asyncio.to_thread(self.remove, evicted)
+
+    async def file_id(self, key: str):
+        if key not in self.entries:
+            return None
+        try:
+            file_id = await asyncio.to_thread(self.read_file_id, key)
+        except OSError:
+            return None
+        if file_id and key in self.entries:
+            self.entries.move_to_end(key)
+            self.file_id_hits += 1
+        return file_id or None
+
+    async def remember_file_id(self, key: str, file_id: str):
+        if key in self.entries and file_id:
+            await asyncio.to_thread(self.write_file_id, key, file_id)
+
+    async def forget_file_id(self, key: str):
+        await asyncio.to_thread(self.remove, [key], ("fid",))
+
+    def drop(self, key: str):
+        self.total -= self.entries.pop(key, 0)
+
+    def evict(self) -> list:
+        # -> ключи, чьи файлы нужно удалить
+        evicted = []
+        while self.total > self.max_bytes and self.entries:
+            key = next(iter(self.entries))
+            self.drop(key)
+            evicted.append(key)
+        return evicted
+
+tts_cache = TtsCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES)
+
+def split_tts_chunks(text: str) -> list:
+    sentences = [s for s in RE_SENTENCE_END.split(text.strip()) if s]
+    if len(sentences) < 2:
+        return [text]
+    first, rest = sentences[0], " ".join(sentences[1:])
+    if len(rest) < TTS_MIN_TAIL:
+        return [text]
+    return [first, rest]
+
+async def synthesize(text: str, voice: str, response_format: str) -> bytes:
+    with timed("tts"):
+        resp = await openai_call(
+            client.audio.speech.create,
             model="tts-1",
             voice=voice,
             input=text,
-            response_format="opus"
-        ) as resp:
-            resp.stream_to_file(ogg_path)
-        with open(ogg_path, "rb") as f:
-            bot.send_voice(chat_id, f)
+            response_format=response_format
+        )
+    return resp.content
+
+async def tts_payload(text: str, voice: str, response_format: str):
+    # -> (ключ кэша, file_id-строка или байты аудио)
+    key = TtsCache.key(text, voice, response_format)
+    file_id = await tts_cache.file_id(key)
+    if file_id:
+        return key, file_id
+    audio = await tts_cache.get(key)
+    if audio is None:
+        audio = await tts_flight.do(key, synthesize_and_cache, key, text, voice, response_format)
+    return key, audio
+
+async def synthesize_and_cache(key: str, text: str, voice: str, response_format: str) -> bytes:
+    audio = await synthesize(text, voice, response_format)
+    await tts_cache.put(key, audio)
+    return audio
+
+async def upload_tts(send, key: str, payload, filename: str, **kwargs):
+    if isinstance(payload, str):
+        try:
+            return await send(payload, **kwargs)
+        except Exception:
+            await tts_cache.forget_file_id(key)  # file_id протух — в следующий раз загрузим заново
+            raise
+    with timed("upload"):
+        msg = await send((filename, payload), **kwargs)
+    media = getattr(msg, "voice", None) or getattr(msg, "audio", None)
+    if media is not None:
+        await tts_cache.remember_file_id(key, media.file_id)
+    return msg
+
+async def send_tts(chat_id: int, text: str, base: str = "reply", voice: str = "alloy"):
+    chunks = split_tts_chunks(text) if TTS_CHUNKING else [text]
+    sent = 0
+    send_voice = functools.partial(tg.send_voice, chat_id)
+    send_audio = functools.partial(tg.send_audio, chat_id)
+    try:
+        tasks = [asyncio.create_task(tts_payload(chunk, voice, "opus")) for chunk in chunks]
+        try:
+            for i, task in enumerate(tasks):
+                key, payload = await task
+                await upload_tts(send_voice, key, payload, f"{base}_{i}.ogg")
+                sent += 1
+        finally:
+            cancel_tasks(*tasks)
         return
     except Exception:
         traceback.print_exc()
     try:
-        mp3_path = f"{base}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.mp3"
-        with client.audio.speech.with_streaming_response.create(
-            model="tts-1",
-            voice=voice,
-            input=text,
-            response_format="mp3"
-        ) as resp:
-            resp.stream_to_file(mp3_path)
-        with open(mp3_path, "rb") as f:
-            bot.send_audio(chat_id, f, title="Antwort (TTS)")
+        # MP3 — только для того, что ещё не отправлено голосом
+        key, payload = await tts_payload(" ".join(chunks[sent:]), voice, "mp3")
+        await upload_tts(send_audio, key, payload, f"{base}.mp3", title="Antwort (TTS)")
     except Exception:
         traceback.print_exc()
 
-# === Детектор "как сказать" ===
-def detect_translation_request(user_text: str) -> bool:
-    triggers = [
-        "как сказать", "как будет по-немецки", "не знаю как сказать", "переведи",
-        "wie sagt man", "how to say", "translate"
+# === Маршрутизация моделей ===
+# Модель и лимит ответа выбираются по маршруту: короткая реплика в chat — дешёвая
+# модель с жёстким лимитом (ответ всё равно 1–2 предложения), разбор ошибок в
+# длинном сообщении — сильная модель. По каждому маршруту считаем время и стоимость.
+MODEL_LIGHT = os.getenv("MODEL_LIGHT", "gpt-4o-mini")
+MODEL_STRONG = os.getenv("MODEL_STRONG", "gpt-4o")
+SHORT_TURN_CHARS = int(os.getenv("SHORT_TURN_CHARS", "60"))  # короче — «короткая реплика»
+
+ROUTES = {
+    "chat_short": {"model": MODEL_LIGHT, "max_tokens": 80},
+    "chat": {"model": MODEL_LIGHT, "max_tokens": 160},
+    "correct_short": {"model": MODEL_LIGHT, "max_tokens": 250},
+    "correct": {"model": MODEL_STRONG, "max_tokens": 450},
+    "translate": {"model": MODEL_LIGHT, "max_tokens": 350},
+    "detector": {"model": MODEL_LIGHT, "max_tokens": 3},
+    "followup": {"model": MODEL_LIGHT, "max_tokens": 60},
+    "summary": {"model": MODEL_LIGHT, "max_tokens": 150},
+}
+
+# USD за 1M токенов: (вход, вход из кэша, выход)
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+}
+
+ROUTE_SECONDS = Histogram("bot_route_seconds", "Completion latency by model route")
+ROUTE_COST = Counter("bot_route_cost_usd_total", "Estimated OpenAI spend by model route")
+
+route_stats = defaultdict(lambda: {"calls": 0, "seconds": 0.0, "cost": 0.0, "truncated": 0})
+
+def pick_route(kind: str, user_text: str) -> str:
+    # kind — режим пользователя или "translate" по вердикту детектора
+    if kind == "translate":
+        return "translate"
+    short = len(user_text) <= SHORT_TURN_CHARS
+    if kind == "chat":
+        return "chat_short" if short else "chat"
+    if kind == "mix":
+        # исправления в mix — только по просьбе, сильная модель тут не нужна
+        return "chat_short" if short else "correct_short"
+    return "correct_short" if short else "correct"
+
+def usage_cost(model: str, usage) -> float:
+    prices = MODEL_PRICES.get(model)
+    if prices is None or usage is None:
+        return 0.0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0
+    prompt = (usage.prompt_tokens or 0) - cached
+    return (prompt * prices[0] + cached * prices[1] + (usage.completion_tokens or 0) * prices[2]) / 1e6
+
+def record_route(route: str, seconds: float, usage, truncated: bool):
+    cost = usage_cost(ROUTES[route]["model"], usage)
+    st = route_stats[route]
+    st["calls"] += 1
+    st["seconds"] += seconds
+    st["cost"] += cost
+    st["truncated"] += truncated
+    ROUTE_SECONDS.observe(seconds, route=route)
+    ROUTE_COST.inc(cost, route=route)
+
+async def routed_completion(route: str, messages: list, **kwargs):
+    cfg = ROUTES[route]
+    started = time.monotonic()
+    resp = await openai_call(
+        client.chat.completions.create, model=cfg["model"], max_tokens=cfg["max_tokens"], messages=messages, **kwargs
+    )
+    truncated = getattr(resp.choices[0], "finish_reason", None) == "length"
+    record_route(route, time.monotonic() - started, resp.usage, truncated)
+    return resp
+
+def trim_to_sentence(text: str) -> str:
+    # ответ упёрся в max_tokens: не показываем оборванное предложение
+    cut = max(text.rfind(ch) for ch in ".!?…")
+    return text[:cut + 1] if cut >= len(text) // 2 else text
+
+def format_route_stats() -> str:
+    if not route_stats:
+        return "• Routes: no calls yet"
+    parts = [
+        f"{name} ({ROUTES[name]['model']}) {st['calls']}× {st['seconds'] / st['calls']:.2f}s ${st['cost']:.4f}"
+        + (f", cut {st['truncated']}" if st["truncated"] else "")
+        for name, st in sorted(route_stats.items())
     ]
-    if any(tk in user_text.lower() for tk in triggers):
+    return "• Routes: " + "; ".join(parts)
+
+# === Детектор "как сказать" ===
+# Локальный классификатор: уверенные "да"/"нет" решаем сами, в LLM уходят только спорные случаи.
+# Триггеры однозначны и ищутся целыми словами; широкие фразы ("in german", "what does",
+# "по-немецки") встречаются и в обычной болтовне, поэтому они лишь признак для оценки.
+TRANSLATION_LEXICON = {
+    "ru": ["как сказать", "как будет по-немецки", "не знаю как сказать", "переведи", "перевести",
+           "как по-немецки"],
+    "uk": ["як сказати", "як буде німецькою", "не знаю як сказати", "переклади", "перекласти"],
+    "en": ["how to say", "how do i say", "how do you say", "translate", "what is the german"],
+    "de": ["wie sagt man", "übersetze", "übersetzen"],
+    "tr": ["nasıl denir", "nasıl söylenir", "almanca nasıl", "almancası", "çevir"],
+    "fa": ["چطور بگویم", "چطور بگم", "چطوری بگم", "ترجمه کن"],
+    "ar": ["كيف أقول", "كيف اقول", "كيف نقول"],
+}
+TRANSLATION_HINTS = {
+    "ru": ["по-немецки", "по немецки", "на немецком", "что значит", "что означает"],
+    "uk": ["німецькою", "по-німецьки", "що означає", "що значить"],
+    "en": ["in german", "what does"],
+    "de": ["was heißt", "was heisst", "was bedeutet"],
+    "tr": ["ne demek"],
+    "fa": ["چی میشه", "به آلمانی", "یعنی چه", "معنی"],
+    "ar": ["بالألمانية", "بالالمانية", "ترجم", "ماذا تعني", "معنى"],
+}
+
+def phrase_regex(lexicon: dict):
+    # (?<!\w)…(?!\w) — граница слова и для кириллицы, и для арабского письма
+    phrases = sorted({p for words in lexicon.values() for p in words}, key=len, reverse=True)
+    return re.compile("|".join(rf"(?<!\w){re.escape(p)}(?!\w)" for p in phrases))
+
+RE_TRANSLATION_TRIGGER = phrase_regex(TRANSLATION_LEXICON)
+RE_TRANSLATION_HINT = phrase_regex(TRANSLATION_HINTS)
+
+# Приветствия и подтверждения — самые частые короткие реплики, в LLM их не отправляем
+SMALL_TALK = {
+    "hallo", "hi", "hey", "hello", "moin", "servus", "danke", "dankeschön", "bitte", "ok", "okay", "okey",
+    "yes", "no", "yeah", "yep", "ja", "nein", "jo", "thanks", "thank", "you", "thx", "bye", "tschüss",
+    "guten", "gute", "morgen", "tag", "abend", "nacht", "super", "gut", "cool", "nice", "great", "sure",
+    "alles", "klar", "genau", "stimmt", "привет", "спасибо", "да", "нет", "ок", "окей", "пока", "хорошо",
+    "ладно", "понятно", "понял", "поняла", "ясно", "доброе", "добрый", "утро", "день", "вечер", "ночи",
+    "привіт", "дякую", "так", "ні", "добре", "зрозуміло", "merhaba", "selam", "teşekkürler",
+    "teşekkür", "ederim", "sağol", "evet", "hayır", "tamam", "سلام", "مرسی", "ممنون", "بله", "نه",
+    "باشه", "خداحافظ", "مرحبا", "شكرا", "نعم", "لا", "حسنا", "أهلا", "اهلا",
+}
+SMALL_TALK_MAX_WORDS = 4
+
+# Признаки для спорных сообщений (без явного триггера)
+RE_LANG_REF = re.compile(r"немецк|німецьк|german(?!y)|deutsch|almanca|آلمانی|الألمان|الالمان")
+WORD_REFS = ["слово", "фраз", "word", "phrase", "wort", "satz", "kelime", "cümle", "کلمه", "جمله", "كلمة", "جملة"]
+GERMAN_STOPWORDS = {
+    "ich", "du", "er", "sie", "es", "wir", "ihr", "bin", "bist", "ist", "sind", "habe", "hast", "hat",
+    "haben", "und", "oder", "aber", "nicht", "kein", "keine", "der", "die", "das", "den", "dem", "ein",
+    "eine", "einen", "mit", "mich", "mir", "dich", "dir", "auch", "heute", "gestern", "morgen", "sehr",
+    "gut", "wie", "was", "wo", "wann", "warum", "zu", "im", "in", "am", "auf", "für", "von", "noch", "schon",
+}
+RE_WORD = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)?")
+RE_QUESTION = re.compile(r"[?؟]")
+RE_QUOTED = re.compile(r"[«\"“„'].{1,60}?[»\"”“']")
+RE_NON_LATIN = re.compile(r"[\u0400-\u04FF\u0600-\u06FF\u0750-\u077F\uFB50-\uFDFF\uFE70-\uFEFF]")  # кириллица и арабское письмо
+RE_LETTER = re.compile(r"[^\W\d_]")
+RE_GERMAN_CHARS = re.compile(r"[äöüß]")
+
+DETECTOR_YES_SCORE = 2.0
+DETECTOR_NO_SCORE = -1.5
+
+detector_stats = {"local_yes": 0, "local_no": 0, "escalated": 0}
+
+def has_translation_trigger(user_text: str) -> bool:
+    return RE_TRANSLATION_TRIGGER.search(user_text.lower()) is not None
+
+def is_small_talk(user_text: str) -> bool:
+    words = RE_WORD.findall(user_text.lower())
+    return len(words) <= SMALL_TALK_MAX_WORDS and all(w in SMALL_TALK for w in words)
+
+def has_word_ref(low: str) -> bool:
+    return any(ref in low for ref in WORD_REFS)
+
+def has_lexical_cue(user_text: str) -> bool:
+    # кавычки, вопрос и кириллица сами по себе — ещё не запрос перевода: «Ты смотрел «Титаник»?»
+    low = user_text.lower()
+    return bool(RE_TRANSLATION_HINT.search(low) or RE_LANG_REF.search(low) or has_word_ref(low))
+
+def translation_score(user_text: str) -> float:
+    # Маленькая линейная модель на ручных признаках
+    low = user_text.lower()
+    words = RE_WORD.findall(low)
+    letters = RE_LETTER.findall(low)
+    non_latin = len(RE_NON_LATIN.findall(low)) / len(letters) if letters else 0.0
+    german = sum(1 for w in words if w in GERMAN_STOPWORDS) / len(words) if words else 0.0
+
+    score = -0.5
+    if RE_QUESTION.search(low):
+        score += 0.8
+    if RE_QUOTED.search(user_text):
+        score += 1.2
+    if RE_TRANSLATION_HINT.search(low) or RE_LANG_REF.search(low):
+        score += 1.0
+    if has_word_ref(low):
+        score += 1.0
+    if non_latin > 0.5:
+        score += 0.6
+        if len(words) <= 3:
+            score += 0.5  # одно-два слова на родном языке — скорее всего, ищут слово
+    if german >= 0.2:
+        score -= 2.0
+    if RE_GERMAN_CHARS.search(low):
+        score -= 0.5
+    return score
+
+def classify_translation_request(user_text: str) -> bool | None:
+    # True/False — уверенный локальный ответ, None — нужен LLM
+    if has_translation_trigger(user_text):
+        detector_stats["local_yes"] += 1
+        return True
+    if is_small_talk(user_text):
+        detector_stats["local_no"] += 1
+        return False
+    score = translation_score(user_text)
+    if score >= DETECTOR_YES_SCORE and has_lexical_cue(user_text):
+        detector_stats["local_yes"] += 1
         return True
+    if score <= DETECTOR_NO_SCORE:
+        detector_stats["local_no"] += 1
+        return False
+    detector_stats["escalated"] += 1
+    return None
+
+async def llm_detect_translation_request(user_text: str) -> bool:
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "Определи: похоже ли сообщение на запрос перевода или поиск слова? Ответь только 'Да' или 'Нет'."},
-                {"role": "user", "content": user_text}
-            ],
-            temperature=0
-        )
+        with timed("detector"):
+            resp = await routed_completion(
+                "detector",
+                [
+                    {"role": "system", "content": "Определи: похоже ли сообщение на запрос перевода или поиск слова? Ответь только 'Да' или 'Нет'."},
+                    {"role": "user", "content": user_text}
+                ],
+                temperature=0,
+                deadline=10,
+            )
         answer = resp.choices[0].message.content.strip().lower()
         return ("да" in answer) or ("yes" in answer)
     except Exception:
         return False
 
+# === Кэш ответов на "как сказать" ===
+# Ключ — нормализованный запрос (без слов-триггеров) и язык объяснений. Опционально —
+# поиск почти совпадающих запросов по сходству символьных триграмм; набор слов при этом
+# должен совпадать с точностью до опечаток ("with milk" и "without milk" — разные запросы).
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "2000"))
+TRANSLATION_CACHE_TTL = int(os.getenv("TRANSLATION_CACHE_TTL_H", "24")) * 3600
+TRANSLATION_CACHE_SIMILARITY = float(os.getenv("TRANSLATION_CACHE_SIMILARITY", "0"))  # 0 — только точные
+TYPO_RATIO = 0.8  # насколько должны совпадать два слова, чтобы считать разницу опечаткой
+RE_NOT_WORD = re.compile(r"[^\w\s]+")
+
+def normalize_query(text: str) -> str:
+    low = unicodedata.normalize("NFC", text).casefold()
+    low = RE_TRANSLATION_HINT.sub(" ", RE_TRANSLATION_TRIGGER.sub(" ", low))
+    return " ".join(RE_NOT_WORD.sub(" ", low).split())
+
+def trigrams(text: str) -> frozenset:
+    padded = f" {text} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def same_words(a: frozenset, b: frozenset) -> bool:
+    left, right = a - b, b - a
+    if len(left) != len(right):
+        return False
+    return all(any(SequenceMatcher(None, w, v).ratio() >= TYPO_RATIO for v in right) for w in left)
+
+class TranslationCache:
+    def __init__(self, size: int, ttl: int, similarity: float):
+        self.size = size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.entries = OrderedDict()  # (lang, norm) -> (expires, reply, trigrams, words)
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def get(self, text: str, lang: str):
+        norm = normalize_query(text)
+        if not norm:
+            return None
+        now = time.monotonic()
+        key = (lang, norm)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > now:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if self.similarity > 0:
+            grams, words = trigrams(norm), frozenset(norm.split())
+            best, best_score = None, self.similarity
+            for (entry_lang, _), (expires, reply, entry_grams, entry_words) in self.entries.items():
+                if entry_lang != lang or expires <= now:
+                    continue
+                score = len(grams & entry_grams) / len(grams | entry_grams)
+                if score >= best_score and same_words(words, entry_words):
+                    best, best_score = reply, score
+            if best is not None:
+                self.near_hits += 1
+                return best
+        self.misses += 1
+        return None
+
+    def put(self, text: str, lang: str, reply: str):
+        norm = normalize_query(text)
+        if not norm or not reply or self.size <= 0:
+            return
+        key = (lang, norm)
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic() + self.ttl, reply, trigrams(norm), frozenset(norm.split()))
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+translation_cache = TranslationCache(TRANSLATION_CACHE_SIZE, TRANSLATION_CACHE_TTL, TRANSLATION_CACHE_SIMILARITY)
+
 # === Генерация ответа с учётом персоны и инициативы ===
 INITIATIVE_CHANCE = 0.35  # вероятность задать уместный встречный вопрос
+# Запускать ли перевод-промпт спекулятивно, параллельно с детектором (дороже, но быстрее)
+SPECULATIVE_TRANSLATION = os.getenv("SPECULATIVE_TRANSLATION", "0") == "1"
 
 def persona_header(p: dict) -> str:
     # Короткое резюме для системного промпта
@@ -443,20 +1911,22 @@ def persona_header(p: dict) -> str:
         "Избегай слишком личных/чувствительных вопросов. "
     )
 
-def generate_followup(user_text: str, persona: dict) -> str:
+async def generate_followup(user_text: str, persona: dict) -> str:
     # Генерируем короткий уместный вопрос по-немецки, связанный с контекстом
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content":
-                    "Du stellst NUR EINE sehr kurze, natürliche Rückfrage auf Deutsch, passend zum letzten Nutzerbeitrag. "
-                    "Kein Smalltalk ohne Bezug. Nicht zu persönlich. 1 Satz."
-                },
-                {"role": "user", "content": user_text}
-            ],
-            temperature=0.7
-        )
+        with timed("followup"):
+            resp = await routed_completion(
+                "followup",
+                [
+                    {"role": "system", "content":
+                        "Du stellst NUR EINE sehr kurze, natürliche Rückfrage auf Deutsch, passend zum letzten Nutzerbeitrag. "
+                        "Kein Smalltalk ohne Bezug. Nicht zu persönlich. 1 Satz."
+                    },
+                    {"role": "user", "content": user_text}
+                ],
+                temperature=0.7,
+                deadline=10,
+            )
         q = resp.choices[0].message.content.strip()
         # Мини-фильтр — чтобы не дублировал
         if len(q) > 0 and "?" in q and len(q) <= 120:
@@ -465,65 +1935,310 @@ def generate_followup(user_text: str, persona: dict) -> str:
         pass
     return ""
 
-def generate_reply(user_text: str, mode: str, lang: str, persona: dict):
-    # язык для объяснений
-    expl_map = {
-        "ru": "на русском",
-        "uk": "українською",
-        "en": "in English",
-        "tr": "Türkçe",
-        "fa": "به فارسی",
-        "ar": "بالعربية",
-    }
-    expl_lang = expl_map.get(lang, "in English")
+# Промпты короче 1024 токенов, порога автоматического prompt caching у OpenAI, поэтому
+# порядок частей на кэш не влияет; из кэша может браться только длинный префикс
+# вместе с историей разговора (см. «Память разговора»). Здесь промпты просто собираются заранее.
+EXPL_LANGS = {
+    "ru": "на русском",
+    "uk": "українською",
+    "en": "in English",
+    "tr": "Türkçe",
+    "fa": "به فارسی",
+    "ar": "بالعربية",
+}
+PROMPT_KINDS = ("translate", "teacher", "mix", "auto", "chat")
+
+def build_system_prompt(kind: str, lang: str, persona: dict) -> str:
+    # kind: "translate" или режим пользователя
+    expl_lang = EXPL_LANGS.get(lang, "in English")
     corrections_tag = t(lang, "corrections")
     no_errors = t(lang, "no_errors")
 
     # базовый системный промпт с персоной
     base_persona = persona_header(persona)
 
-    if detect_translation_request(user_text):
-        system = (
+    if kind == "translate":
+        return (
             base_persona +
             "Der Nutzer sucht eine Übersetzung oder weiß nicht, wie man etwas auf Deutsch sagt. "
             f"Gib die passende Formulierung, ein kurzes Grammatikkommentar {expl_lang} und 2–3 Beispiele auf Deutsch."
         )
-    elif mode == "teacher":
-        system = (
+    if kind == "teacher":
+        return (
             base_persona +
             "Du bist Deutschlehrer. Antworte zuerst auf Deutsch (1–2 Sätze), "
             f"dann gib einen separaten Block '{corrections_tag}' mit kurzen Korrekturen {expl_lang}. "
             f"Wenn es keine Fehler gibt, schreibe '{no_errors}'."
         )
-    elif mode == "mix":
-        system = (
+    if kind == "mix":
+        return (
             base_persona +
             "Du bist Gesprächspartner auf Deutsch. Antworte kurz und natürlich. "
             "Korrigiere Fehler nur, wenn der Nutzer es ausdrücklich verlangt (z. B. 'korrigiere', 'исправь')."
         )
-    elif mode == "auto":
-        system = (
+    if kind == "auto":
+        return (
             base_persona +
             "Du bist Gesprächspartner auf Deutsch. Antworte kurz und natürlich (1–2 Sätze). "
             f"Wenn es Fehler im Nutzersatz gibt, füge einen separaten Block '{corrections_tag}' "
             f"mit kurzen Erklärungen {expl_lang} hinzu. Wenn keine Fehler da sind, antworte nur auf Deutsch."
         )
+    return (
+        base_persona +
+        "Du bist Gesprächspartner auf Deutsch. Antworte kurz und natürlich. Keine Korrekturen, keine Erklärungen."
+    )
+
+# Все комбинации (персона, режим, язык) собираем один раз при старте
+SYSTEM_PROMPTS = MappingProxyType({
+    (p["id"], kind, lang): build_system_prompt(kind, lang, p)
+    for p in PERSONAS for kind in PROMPT_KINDS for lang in LANGS
+})
+
+def system_prompt(kind: str, lang: str, persona: dict) -> str:
+    prompt = SYSTEM_PROMPTS.get((persona["id"], kind, lang))
+    return prompt if prompt is not None else build_system_prompt(kind, lang, persona)
+
+# Учёт prompt caching: сколько токенов промпта провайдер взял из кэша и как это
+# сказалось на времени до первого токена
+prompt_cache_stats = {
+    "calls": 0, "prompt_tokens": 0, "cached_tokens": 0,
+    "cached_calls": 0, "ttft_cached": 0.0, "ttft_uncached": 0.0,
+}
+
+def record_usage(usage, ttft: float):
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0
+    st = prompt_cache_stats
+    st["calls"] += 1
+    st["prompt_tokens"] += usage.prompt_tokens or 0
+    st["cached_tokens"] += cached
+    if cached:
+        st["cached_calls"] += 1
+        st["ttft_cached"] += ttft
     else:
-        system = (
-            base_persona +
-            "Du bist Gesprächspartner auf Deutsch. Antworte kurz und natürlich. Keine Korrekturen, keine Erklärungen."
-        )
+        st["ttft_uncached"] += ttft
+
+def format_prompt_cache_stats() -> str:
+    st = prompt_cache_stats
+    if not st["calls"]:
+        return "• Prompt cache: no calls yet"
+    share = 100 * st["cached_tokens"] / st["prompt_tokens"] if st["prompt_tokens"] else 0
+    uncached = st["calls"] - st["cached_calls"]
+    ttft_hit = f"{st['ttft_cached'] / st['cached_calls']:.2f}s" if st["cached_calls"] else "—"
+    ttft_miss = f"{st['ttft_uncached'] / uncached:.2f}s" if uncached else "—"
+    return (
+        f"• Prompt cache: {st['cached_tokens']}/{st['prompt_tokens']} tokens ({share:.0f}%), "
+        f"TTFT hit {ttft_hit} / miss {ttft_miss}"
+    )
 
-    # Основной ответ
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": user_text}
-        ],
+# === Стриминг ответа (плейсхолдер + editMessageText) ===
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # Telegram: ~1 правка/сек на чат
+STREAM_PLACEHOLDER = "…"
+
+class ReplyStreamer:
+    """Показывает ответ по мере генерации: немецкая часть и блок исправлений — отдельными сообщениями.
+
+    Несколько спекулятивных генераций могут писать в один стример под разными ключами;
+    на экран попадает только та, что выбрана через claim().
+    """
+
+    def __init__(self, chat_id: int, lang: str):
+        self.chat_id = chat_id
+        self.corrections_tag = t(lang, "corrections")
+        self.owner = None
+        self.latest = {}
+        self.reply_msg = None
+        self.explain_msg = None
+        self.shown = {}
+        self.last_edit = 0.0
+
+    async def start(self):
+        self.reply_msg = await tg.send_message(self.chat_id, STREAM_PLACEHOLDER)
+
+    async def claim(self, key: str):
+        self.owner = key
+        if key in self.latest:
+            await self.render(self.latest[key], force=True)
+
+    async def feed(self, key: str, text: str):
+        self.latest[key] = text
+        if key == self.owner:
+            await self.render(text)
+
+    def split(self, text: str):
+        # Делим на немецкую часть и исправления; хвост, похожий на начало тега, придерживаем
+        tag = self.corrections_tag
+        if tag in text:
+            head, tail = text.split(tag, 1)
+            return head.strip(), f"{tag} {tail.strip()}".strip()
+        for n in range(min(len(tag) - 1, len(text)), 0, -1):
+            if tag.startswith(text[-n:]):
+                return text[:-n].strip(), ""
+        return text.strip(), ""
+
+    async def render(self, text: str, force: bool = False):
+        now = asyncio.get_running_loop().time()
+        german, explain = self.split(text)
+        if explain and self.explain_msg is None:
+            # блок исправлений начался — немецкую часть дописываем сразу, исправления шлём отдельно
+            await self.edit("reply", german)
+            self.explain_msg = await tg.send_message(self.chat_id, f"✍️ {explain}")
+            self.shown["explain"] = f"✍️ {explain}"
+            self.last_edit = now
+            return
+        if not force and now - self.last_edit < STREAM_EDIT_INTERVAL:
+            return
+        self.last_edit = now
+        if self.explain_msg is not None:
+            await self.edit("explain", f"✍️ {explain}")
+        else:
+            await self.edit("reply", german)
+
+    async def edit(self, which: str, text: str, final: bool = False):
+        msg = self.reply_msg if which == "reply" else self.explain_msg
+        if msg is None or not text or self.shown.get(which) == text:
+            return
+        try:
+            await tg.edit_message_text(text, self.chat_id, msg.message_id)
+            self.shown[which] = text
+        except Exception:
+            # промежуточные правки не критичны (429, "message is not modified")
+            if final:
+                traceback.print_exc()
+
+    async def finish(self, german_reply: str, explain: str):
+        await self.edit("reply", german_reply, final=True)
+        if explain:
+            if self.explain_msg is None:
+                await tg.send_message(self.chat_id, f"✍️ {explain}")
+            else:
+                await self.edit("explain", f"✍️ {explain}", final=True)
+
+    async def abort(self, text: str):
+        # плейсхолдер превращаем в сообщение об ошибке; уже показанный ответ не трогаем
+        if self.reply_msg is None or "reply" in self.shown:
+            await tg.send_message(self.chat_id, text)
+        else:
+            await self.edit("reply", text, final=True)
+
+async def complete_reply(system: str, user_text: str, streamer=None, key: str = "", history=None,
+                         route: str = "chat") -> str:
+    messages = [
+        {"role": "system", "content": system},
+        *(history or []),
+        {"role": "user", "content": user_text}
+    ]
+    started = time.monotonic()
+    if streamer is None:
+        resp = await routed_completion(route, messages, temperature=0.7)
+        record_usage(resp.usage, time.monotonic() - started)
+        full = resp.choices[0].message.content.strip()
+        return trim_to_sentence(full) if getattr(resp.choices[0], "finish_reason", None) == "length" else full
+
+    cfg = ROUTES[route]
+    stream = await openai_call(
+        client.chat.completions.create,
+        model=cfg["model"],
+        max_tokens=cfg["max_tokens"],
+        messages=messages,
         temperature=0.7,
+        stream=True,
+        stream_options={"include_usage": True},
     )
-    full = resp.choices[0].message.content.strip()
+    full = ""
+    ttft = None
+    usage = None
+    finish_reason = None
+    async for chunk in stream:
+        if chunk.usage is not None:
+            usage = chunk.usage
+            record_usage(usage, ttft or 0.0)
+            count_tokens(cfg["model"], usage)
+        if not chunk.choices:
+            continue
+        finish_reason = getattr(chunk.choices[0], "finish_reason", None) or finish_reason
+        delta = chunk.choices[0].delta.content or ""
+        if delta:
+            if ttft is None:
+                ttft = time.monotonic() - started
+            full += delta
+            await streamer.feed(key, full)
+    record_route(route, time.monotonic() - started, usage, finish_reason == "length")
+    full = full.strip()
+    return trim_to_sentence(full) if finish_reason == "length" else full
+
+def cancel_tasks(*tasks):
+    for task in tasks:
+        if task is not None and not task.done():
+            task.cancel()
+
+async def fan_out_reply(user_text: str, mode: str, lang: str, persona: dict, streamer=None, history=None) -> str:
+    # Детектор, основной ответ (и, опционально, перевод-вариант) идут параллельно;
+    # по вердикту детектора берём нужный вариант, лишний отменяем.
+    async def reply(kind: str):
+        if kind == "translate":
+            cached = translation_cache.get(user_text, lang)
+            if cached is not None:
+                if streamer is not None:
+                    await streamer.feed(kind, cached)
+                return cached
+        route = pick_route(kind, user_text)
+        with timed("completion"):
+            full = await complete_reply(system_prompt(kind, lang, persona), user_text, streamer, kind, history, route)
+        if kind == "translate":
+            translation_cache.put(user_text, lang, full)
+        return full
+
+    verdict = classify_translation_request(user_text)
+    if verdict is not None:
+        kind = "translate" if verdict else mode
+        if streamer is not None:
+            await streamer.claim(kind)
+        return await reply(kind)
+
+    detect_task = asyncio.create_task(llm_detect_translation_request(user_text))
+    mode_task = asyncio.create_task(reply(mode))
+    translate_task = None
+    if SPECULATIVE_TRANSLATION:
+        translate_task = asyncio.create_task(reply("translate"))
+    try:
+        kind = "translate" if await detect_task else mode
+        if streamer is not None:
+            await streamer.claim(kind)
+        if kind == "translate":
+            cancel_tasks(mode_task)
+            if translate_task is None:
+                return await reply("translate")
+            return await translate_task
+        cancel_tasks(translate_task)
+        return await mode_task
+    finally:
+        cancel_tasks(detect_task, mode_task, translate_task)
+
+async def generate_reply(user_text: str, mode: str, lang: str, persona: dict, streamer=None, history=None):
+    if streamer is not None:
+        # токены идут в плейсхолдер конкретного чата — с чужим streamer общий вызов не делим
+        return await compose_reply(user_text, mode, lang, persona, streamer, history)
+    key = fingerprint(user_text, persona["id"], mode, lang, history or [])
+    return await reply_flight.do(key, compose_reply, user_text, mode, lang, persona, None, history)
+
+async def compose_reply(user_text: str, mode: str, lang: str, persona: dict, streamer=None, history=None):
+    corrections_tag = t(lang, "corrections")
+    no_errors = t(lang, "no_errors")
+
+    # follow-up зависит только от user_text и персоны — стартуем его сразу, вместе с основным ответом
+    follow_task = None
+    if random.random() < INITIATIVE_CHANCE and not scheduler.should_skip_followup():
+        follow_task = asyncio.create_task(generate_followup(user_text, persona))
+
+    try:
+        full = await fan_out_reply(user_text, mode, lang, persona, streamer, history)
+    except BaseException:
+        cancel_tasks(follow_task)
+        raise
 
     german_reply = full
     explain = ""
@@ -536,17 +2251,111 @@ def generate_reply(user_text: str, mode: str, lang: str, persona: dict):
         explain = f"{corrections_tag} {tail}" if tail else f"{corrections_tag} {no_errors}"
 
     # С вероятностью — добавить уместный короткий follow-up вопрос
-    if random.random() < INITIATIVE_CHANCE:
-        follow = generate_followup(user_text, persona)
+    if follow_task is not None:
+        follow = await follow_task
         if follow:
-            # Если есть блок исправлений — зададим вопрос ПОСЛЕ немецкой части, но ДО исправлений
-            if explain:
-                german_reply = (german_reply + ("\n\n" if german_reply else "") + follow).strip()
-            else:
-                german_reply = (german_reply + ("\n\n" if german_reply else "") + follow).strip()
+            # Вопрос идёт ПОСЛЕ немецкой части, но ДО исправлений
+            german_reply = (german_reply + ("\n\n" if german_reply else "") + follow).strip()
 
     return german_reply, explain
 
+# === Память разговора ===
+# Последние MEMORY_TURNS реплик храним дословно, более старые сворачиваются в краткое
+# резюме фоновым запросом. В промпт история попадает в пределах MEMORY_TOKEN_BUDGET.
+# Сворачиваем пачкой, а не по реплике: между сворачиваниями история в промпте только
+# дописывается в конец, и префикс (системный промпт, резюме, ранние реплики) остаётся
+# одинаковым — на длинных разговорах его подхватывает prompt caching.
+MEMORY_TURNS = int(os.getenv("MEMORY_TURNS", "6"))
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "800"))
+MEMORY_MAX_USERS = int(os.getenv("MEMORY_MAX_USERS", "5000"))
+MEMORY_IDLE_TTL = int(os.getenv("MEMORY_IDLE_TTL_MIN", "360")) * 60
+
+def estimate_tokens(text: str) -> int:
+    # грубая оценка без токенизатора: ~3 символа на токен для смеси немецкого и кириллицы
+    return len(text) // 3 + 4
+
+class Conversation:
+    def __init__(self):
+        self.turns = deque()  # (user_text, reply)
+        self.folding = []     # вытесненные реплики, которые ещё не вошли в резюме
+        self.summary = ""
+        self.summarizing = False
+        self.last_seen = time.monotonic()
+
+class ConversationMemory:
+    def __init__(self):
+        self.users = OrderedDict()  # user_id -> Conversation, от давно неактивных к свежим
+        self.tasks = set()
+
+    def get(self, user_id: int) -> Conversation:
+        conv = self.users.get(user_id)
+        if conv is None:
+            conv = self.users[user_id] = Conversation()
+            self.evict()
+        self.users.move_to_end(user_id)
+        conv.last_seen = time.monotonic()
+        return conv
+
+    def evict(self):
+        deadline = time.monotonic() - MEMORY_IDLE_TTL
+        while self.users:
+            user_id, conv = next(iter(self.users.items()))
+            if len(self.users) <= MEMORY_MAX_USERS and conv.last_seen >= deadline:
+                break
+            del self.users[user_id]
+
+    def context(self, user_id: int) -> list:
+        conv = self.users.get(user_id)
+        if conv is None:
+            return []
+        budget = MEMORY_TOKEN_BUDGET
+        messages = []
+        for user_text, reply in reversed(conv.turns):
+            cost = estimate_tokens(user_text) + estimate_tokens(reply)
+            if cost > budget:
+                break
+            budget -= cost
+            messages[:0] = [{"role": "user", "content": user_text}, {"role": "assistant", "content": reply}]
+        if conv.summary and estimate_tokens(conv.summary) <= budget:
+            messages.insert(0, {"role": "system", "content": f"Bisheriges Gespräch (Zusammenfassung): {conv.summary}"})
+        return messages
+
+    def remember(self, user_id: int, user_text: str, reply: str):
+        conv = self.get(user_id)
+        conv.turns.append((user_text, reply))
+        if len(conv.turns) > MEMORY_TURNS:
+            while len(conv.turns) > MEMORY_TURNS // 2:
+                conv.folding.append(conv.turns.popleft())
+        if conv.folding and not conv.summarizing:
+            conv.summarizing = True
+            task = asyncio.create_task(self.summarize(conv))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def summarize(self, conv: Conversation):
+        try:
+            while conv.folding:
+                batch, conv.folding = conv.folding, []
+                dialog = "\n".join(f"User: {u}\nBot: {r}" for u, r in batch)
+                resp = await routed_completion(
+                    "summary",
+                    [
+                        {"role": "system", "content":
+                            "Fasse das Gespräch in höchstens 3 kurzen Sätzen auf Deutsch zusammen: "
+                            "Themen, Fakten über den Nutzer, offene Fragen. Nur die Zusammenfassung."
+                        },
+                        {"role": "user", "content": f"Bisherige Zusammenfassung: {conv.summary or '—'}\n\n{dialog}"}
+                    ],
+                    temperature=0.2,
+                )
+                conv.summary = resp.choices[0].message.content.strip()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            conv.summarizing = False
+
+memory = ConversationMemory()
+
 # === Language menu ===
 def build_language_keyboard():
     kb = types.InlineKeyboardMarkup()
@@ -561,140 +2370,826 @@ def build_language_keyboard():
         kb.row(*row)
     return kb
 
-def send_language_menu(chat_id: int, lang: str):
-    kb = build_language_keyboard()
-    bot.send_message(chat_id, t(lang, "lang_choose"), reply_markup=kb)
+LANGUAGE_KEYBOARD = build_language_keyboard().to_json()
+LANG_SET_TEXTS = MappingProxyType({code: t(code, "lang_set").format(lang=LANG_TITLES[code]) for code in LANGS})
+
+async def send_language_menu(chat_id: int, lang: str):
+    await tg.send_message(chat_id, t(lang, "lang_choose"), reply_markup=LANGUAGE_KEYBOARD)
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("lang_"))
-def cb_set_lang(call):
+@with_update_slot
+async def cb_set_lang(call):
     code = call.data.split("_", 1)[1]
     set_lang(call.from_user.id, code)
     # фиксируем персону при первом взаимодействии (если ещё не зафиксирована)
     _ = get_persona(call.from_user.id)
 
-    bot.answer_callback_query(call.id)
-    bot.send_message(call.message.chat.id, t(code, "lang_set").format(lang=LANG_TITLES[code]))
-    bot.send_message(call.message.chat.id, t(code, "help"))
+    await tg.answer_callback_query(call.id)
+    await tg.send_message(call.message.chat.id, LANG_SET_TEXTS.get(code) or t(code, "lang_set").format(lang=code))
+    await tg.send_message(call.message.chat.id, t(code, "help"))
 
 # === Команды утилиты/донат/язык/админ ===
 @bot.message_handler(commands=['donate'])
-def donate_cmd(message):
-    send_donate_message(message.chat.id, get_lang(message.from_user.id), short=False)
+@with_update_slot
+async def donate_cmd(message):
+    await send_donate_message(message.chat.id, get_lang(message.from_user.id), short=False)
 
 @bot.message_handler(commands=['stats'])
-def admin_stats(message):
+@with_update_slot
+async def admin_stats(message):
     if ADMIN_ID and message.from_user.id == ADMIN_ID:
-        bot.send_message(message.chat.id, format_admin_stats(7))
+        await tg.send_message(message.chat.id, format_admin_stats(7))
     else:
-        bot.send_message(message.chat.id, t(get_lang(message.from_user.id), "admin_only"))
+        await tg.send_message(message.chat.id, t(get_lang(message.from_user.id), "admin_only"))
 
 @bot.message_handler(commands=['language'])
-def language_cmd(message):
-    send_language_menu(message.chat.id, get_lang(message.from_user.id))
+@with_update_slot
+async def language_cmd(message):
+    await send_language_menu(message.chat.id, get_lang(message.from_user.id))
 
 # === Команды режима/старт ===
 @bot.message_handler(commands=['start', 'help'])
-def start(message):
+@with_update_slot
+async def start(message):
     # зарегистрируем визит
     if message.from_user.id not in user_stats:
-        user_stats[message.from_user.id] = {"total": 0, "text": 0, "voice": 0, "first": utcnow(), "last": utcnow()}
+        register_user(message.from_user.id, utcnow().toordinal())
 
     # назначим персону, если ещё нет
     _ = get_persona(message.from_user.id)
 
     # стартовый экран
     if (message.text == "/start") and (message.from_user.id not in user_langs):
-        kb = build_language_keyboard()
-        bot.send_message(message.chat.id, t("en", "greet"), reply_markup=kb)
+        await tg.send_message(message.chat.id, t("en", "greet"), reply_markup=LANGUAGE_KEYBOARD)
         return
 
     lang = get_lang(message.from_user.id)
-    bot.send_message(message.chat.id, t(lang, "help"))
+    await tg.send_message(message.chat.id, t(lang, "help"))
 
 @bot.message_handler(commands=['teacher_on'])
-def teacher_on(message):
+@with_update_slot
+async def teacher_on(message):
     set_mode(message.from_user.id, "teacher")
-    bot.send_message(message.chat.id, t(get_lang(message.from_user.id), "mode_teacher_on"))
+    await tg.send_message(message.chat.id, t(get_lang(message.from_user.id), "mode_teacher_on"))
 
 @bot.message_handler(commands=['teacher_off'])
-def teacher_off(message):
+@with_update_slot
+async def teacher_off(message):
     set_mode(message.from_user.id, "chat")
-    bot.send_message(message.chat.id, t(get_lang(message.from_user.id), "mode_chat_on"))
+    await tg.send_message(message.chat.id, t(get_lang(message.from_user.id), "mode_chat_on"))
 
 @bot.message_handler(commands=['mix'])
-def mix_mode(message):
+@with_update_slot
+async def mix_mode(message):
     set_mode(message.from_user.id, "mix")
-    bot.send_message(message.chat.id, t(get_lang(message.from_user.id), "mode_mix_on"))
+    await tg.send_message(message.chat.id, t(get_lang(message.from_user.id), "mode_mix_on"))
 
 @bot.message_handler(commands=['auto'])
-def auto_mode(message):
+@with_update_slot
+async def auto_mode(message):
     set_mode(message.from_user.id, "auto")
-    bot.send_message(message.chat.id, t(get_lang(message.from_user.id), "mode_auto_on"))
+    await tg.send_message(message.chat.id, t(get_lang(message.from_user.id), "mode_auto_on"))
+
+STATUS_TEXTS = MappingProxyType({
+    (lang, mode): t(lang, "status").format(mode=label)
+    for lang in LANGS for mode, label in t(lang, "modes_labels").items()
+})
 
 @bot.message_handler(commands=['status'])
-def status(message):
+@with_update_slot
+async def status(message):
     lang = get_lang(message.from_user.id)
-    labels = I18N[lang]["modes_labels"]
     mode = get_mode(message.from_user.id)
-    bot.send_message(message.chat.id, t(lang, "status").format(mode=labels.get(mode, mode)))
+    text = STATUS_TEXTS.get((lang, mode)) or t(lang, "status").format(mode=mode)
+    await tg.send_message(message.chat.id, text)
+
+@bot.message_handler(commands=['merge'])
+@with_update_slot
+async def merge_cmd(message):
+    merge = not get_merge(message.from_user.id)
+    set_merge(message.from_user.id, merge)
+    await tg.send_message(message.chat.id, t(get_lang(message.from_user.id), "merge_on" if merge else "merge_off"))
+
+# === Загрузка голосовых ===
+# Голосовое читаем потоково в SpooledTemporaryFile: обычные заметки остаются в памяти,
+# слишком большие уходят в анонимный временный файл, который удаляется при закрытии.
+VOICE_MEMORY_LIMIT = int(os.getenv("VOICE_MEMORY_LIMIT_KB", "2048")) * 1024
+VOICE_MAX_BYTES = 20 * 1024 * 1024  # больше Bot API всё равно не отдаёт
+
+async def download_voice(file_path: str):
+    url = f"{TELEGRAM_API_URL}/file/bot{BOT_TOKEN}/{file_path}"
+    buf = tempfile.SpooledTemporaryFile(max_size=VOICE_MEMORY_LIMIT)
+    try:
+        session = await asyncio_helper.session_manager.get_session()
+        async with session.get(url) as response:
+            if response.status != 200:
+                raise asyncio_helper.ApiHTTPException("Download file", response)
+            size = 0
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                size += len(chunk)
+                if size > VOICE_MAX_BYTES:
+                    raise ValueError(f"voice file is larger than {VOICE_MAX_BYTES} bytes")
+                buf.write(chunk)
+        buf.seek(0)
+        return buf
+    except BaseException:
+        buf.close()
+        raise
+
+async def transcribe_voice(audio, model: str):
+    audio.seek(0)  # при повторе файл читается заново
+    return await client.audio.transcriptions.create(
+        model=model,
+        file=("voice.ogg", audio)
+    )
+
+# === Предобработка голосовых ===
+# Длительность известна из апдейта ещё до скачивания: сверхдлинные отклоняем сразу,
+# длинные обрезаем до VOICE_MAX_SECONDS. Тишину в начале и конце срезает ffmpeg
+# (если он установлен), расшифровки кэшируются по file_unique_id — пересланное
+# голосовое не расшифровывается второй раз.
+VOICE_MAX_SECONDS = int(os.getenv("VOICE_MAX_SECONDS", "120"))
+VOICE_REJECT_SECONDS = int(os.getenv("VOICE_REJECT_SECONDS", "600"))
+VOICE_SILENCE_DB = os.getenv("VOICE_SILENCE_DB", "-45")
+TRANSCRIPT_CACHE_SIZE = int(os.getenv("TRANSCRIPT_CACHE_SIZE", "5000"))
+FFMPEG = shutil.which("ffmpeg")
+# silenceremove режет только начало, поэтому хвост срезаем на развёрнутом звуке
+SILENCE_FILTER = (
+    f"silenceremove=start_periods=1:start_threshold={VOICE_SILENCE_DB}dB:start_silence=0.2,areverse,"
+    f"silenceremove=start_periods=1:start_threshold={VOICE_SILENCE_DB}dB:start_silence=0.2,areverse"
+)
+
+voice_stats = {"rejected": 0, "truncated": 0, "trimmed": 0, "bytes_in": 0, "bytes_out": 0}
+
+def voice_limit(duration: int):
+    # -> None (как есть), секунды для обрезки или "reject"
+    if duration > VOICE_REJECT_SECONDS or (duration > VOICE_MAX_SECONDS and not FFMPEG):
+        return "reject"
+    if duration > VOICE_MAX_SECONDS:
+        return VOICE_MAX_SECONDS
+    return None
+
+class VoiceTooLong(Exception):
+    pass  # args[0] — сколько секунд мы готовы принять
+
+async def preprocess_voice(audio, limit=None):
+    if not FFMPEG:
+        return audio
+    try:
+        audio.seek(0)
+        data = audio.read()
+        args = [FFMPEG, "-hide_banner", "-loglevel", "error"]
+        if limit:
+            args += ["-t", str(limit)]
+        args += ["-i", "pipe:0", "-af", SILENCE_FILTER, "-c:a", "libopus", "-b:a", "24k",
+                 "-application", "voip", "-f", "ogg", "pipe:1"]
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        out, err = await proc.communicate(data)
+        if proc.returncode != 0 or not out:
+            print(f"⚠️ ffmpeg failed: {err.decode(errors='replace').strip()[:200]}")
+            if limit:
+                # обрезать не смогли — длинную запись целиком не расшифровываем
+                raise VoiceTooLong(limit)
+            return audio  # не смогли обработать — отправим как есть
+    except BaseException:
+        audio.close()
+        raise
+    voice_stats["trimmed"] += 1
+    if limit:
+        voice_stats["truncated"] += 1
+    voice_stats["bytes_in"] += len(data)
+    voice_stats["bytes_out"] += len(out)
+    audio.close()
+    trimmed = tempfile.SpooledTemporaryFile(max_size=VOICE_MEMORY_LIMIT)
+    trimmed.write(out)
+    trimmed.seek(0)
+    return trimmed
+
+class TranscriptCache:
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = OrderedDict()  # file_unique_id -> текст
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_unique_id: str):
+        text = self.entries.get(file_unique_id)
+        if text is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(file_unique_id)
+        self.hits += 1
+        return text
+
+    def put(self, file_unique_id: str, text: str):
+        if not text or self.size <= 0:
+            return
+        self.entries[file_unique_id] = text
+        self.entries.move_to_end(file_unique_id)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+transcript_cache = TranscriptCache(TRANSCRIPT_CACHE_SIZE)
+transcript_flight = SingleFlight("transcripts")
+
+async def download_and_transcribe(voice) -> str:
+    limit = voice_limit(voice.duration)
+    with timed("download"):
+        file_info = await tg.get_file(voice.file_id)
+        audio = await telegram_call(download_voice, file_info.file_path)
+    with timed("preprocess"):
+        audio = await preprocess_voice(audio, limit)
+    with audio, timed("transcription"):
+        transcript = await openai_call(transcribe_voice, audio, model="gpt-4o-mini-transcribe")
+    text = getattr(transcript, "text", str(transcript)).strip()
+    transcript_cache.put(voice.file_unique_id, text)
+    return text
+
+async def voice_transcript(voice) -> str:
+    text = transcript_cache.get(voice.file_unique_id)
+    if text is not None:
+        return text
+    return await transcript_flight.do(voice.file_unique_id, download_and_transcribe, voice)
+
+def format_voice_stats() -> str:
+    saved = voice_stats["bytes_in"] - voice_stats["bytes_out"]
+    return (
+        f"• Voice: transcript cache {transcript_cache.hits}/{transcript_cache.hits + transcript_cache.misses}, "
+        f"rejected {voice_stats['rejected']}, truncated {voice_stats['truncated']}, "
+        f"trimmed {voice_stats['trimmed']} ({saved // 1024} KB saved)"
+        + ("" if FFMPEG else ", no ffmpeg")
+    )
 
 # === Voice ===
 @bot.message_handler(content_types=['voice'])
-def handle_voice(message):
+@with_update_slot
+async def handle_voice(message):
     lang = get_lang(message.from_user.id)
     persona = get_persona(message.from_user.id)
+    streamer = None
     try:
         bump_stats(message.from_user.id, "voice")
         mode = get_mode(message.from_user.id)
-
-        file_info = bot.get_file(message.voice.file_id)
-        file = requests.get(f'https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}', timeout=30)
-        local_path = "voice.ogg"
-        with open(local_path, "wb") as f:
-            f.write(file.content)
-
-        with open(local_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="gpt-4o-mini-transcribe",
-                file=audio_file
-            )
-        user_text = getattr(transcript, "text", str(transcript)).strip()
-
-        de_answer, explain = generate_reply(user_text, mode, lang, persona)
-
-        bot.send_message(message.chat.id, de_answer)
-        send_tts(message.chat.id, de_answer, base="voice_reply", voice=persona.get("voice", "alloy"))
-
-        if explain:
-            bot.send_message(message.chat.id, f"✍️ {explain}")
-
-        inc_and_maybe_remind(message.chat.id, message.from_user.id)
-
+        if STREAM_REPLIES:
+            streamer = ReplyStreamer(message.chat.id, lang)
+            await streamer.start()
+
+        if voice_limit(message.voice.duration) == "reject":
+            raise VoiceTooLong(VOICE_REJECT_SECONDS if FFMPEG else VOICE_MAX_SECONDS)
+        user_text = await voice_transcript(message.voice)
+
+        history = memory.context(message.from_user.id)
+        de_answer, explain = await generate_reply(user_text, mode, lang, persona, streamer, history)
+        memory.remember(message.from_user.id, user_text, de_answer)
+
+        merged = streamer is None and explain and get_merge(message.from_user.id)
+        if merged:
+            await tg.send_message(message.chat.id, f"{de_answer}\n\n✍️ {explain}")
+        elif streamer is None:
+            await tg.send_message(message.chat.id, de_answer)
+        else:
+            await streamer.finish(de_answer, explain)
+        if not scheduler.should_skip_tts():
+            await send_tts(message.chat.id, de_answer, base="voice_reply", voice=persona.get("voice", "alloy"))
+
+        if explain and streamer is None and not merged:
+            await tg.send_message(message.chat.id, f"✍️ {explain}")
+
+        await inc_and_maybe_remind(message.chat.id, message.from_user.id)
+
+    except VoiceTooLong as e:
+        voice_stats["rejected"] += 1
+        text = t(lang, "voice_too_long").format(limit=math.ceil(e.args[0] / 60))
+        if streamer is not None:
+            await streamer.abort(text)
+        else:
+            await tg.send_message(message.chat.id, text)
+    except RateLimited:
+        if streamer is not None:
+            await streamer.abort(t(lang, "rate_limited"))
+        else:
+            await tg.send_message(message.chat.id, t(lang, "rate_limited"))
     except Exception:
-        bot.send_message(message.chat.id, t(lang, "err_voice"))
+        if streamer is not None:
+            await streamer.abort(t(lang, "err_voice"))
+        else:
+            await tg.send_message(message.chat.id, t(lang, "err_voice"))
         traceback.print_exc()
 
 # === Text ===
 @bot.message_handler(func=lambda m: True, content_types=['text'])
-def handle_text(message):
+@with_update_slot
+async def handle_text(message):
     lang = get_lang(message.from_user.id)
     persona = get_persona(message.from_user.id)
+    streamer = None
     try:
         bump_stats(message.from_user.id, "text")
         mode = get_mode(message.from_user.id)
-        de_answer, explain = generate_reply(message.text, mode, lang, persona)
+        if STREAM_REPLIES:
+            streamer = ReplyStreamer(message.chat.id, lang)
+            await streamer.start()
+        history = memory.context(message.from_user.id)
+        de_answer, explain = await generate_reply(message.text, mode, lang, persona, streamer, history)
+        memory.remember(message.from_user.id, message.text, de_answer)
+
+        merged = streamer is None and explain and get_merge(message.from_user.id)
+        if merged:
+            await tg.send_message(message.chat.id, f"{de_answer}\n\n✍️ {explain}")
+        elif streamer is None:
+            await tg.send_message(message.chat.id, de_answer)
+        else:
+            await streamer.finish(de_answer, explain)
+        if not scheduler.should_skip_tts():
+            await send_tts(message.chat.id, de_answer, base="text_reply", voice=persona.get("voice", "alloy"))
+
+        if explain and streamer is None and not merged:
+            await tg.send_message(message.chat.id, f"✍️ {explain}")
+
+        await inc_and_maybe_remind(message.chat.id, message.from_user.id)
+
+    except RateLimited:
+        if streamer is not None:
+            await streamer.abort(t(lang, "rate_limited"))
+        else:
+            await tg.send_message(message.chat.id, t(lang, "rate_limited"))
+    except Exception:
+        if streamer is not None:
+            await streamer.abort(t(lang, "err_text"))
+        else:
+            await tg.send_message(message.chat.id, t(lang, "err_text"))
+        traceback.print_exc()
 
-        bot.send_message(message.chat.id, de_answer)
-        send_tts(message.chat.id, de_answer, base="text_reply", voice=persona.get("voice", "alloy"))
+# === Webhook-сервер ===
+# Если задан WEBHOOK_URL, бот слушает PORT (internal_port в fly.toml) вместо long polling:
+# проверяем секрет, сразу отвечаем Telegram 200 и кладём апдейт в очередь.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # напр. https://telegram-german-bot.fly.dev
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_DRAIN_TIMEOUT = 20  # сколько ждём очередь при остановке машины (kill_timeout в fly.toml — больше)
+PORT = int(os.getenv("PORT", "8080"))
+SERVE_METRICS = os.getenv("SERVE_METRICS", "0") == "1"  # /metrics без вебхука (long polling)
+# /metrics открыт только изнутри: сборщик Fly ходит по приватной сети напрямую, а публичные
+# запросы приходят через fly-proxy с заголовком Fly-Client-IP. Снаружи — только с токеном.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+PROXY_HEADERS = ("Fly-Client-IP", "X-Forwarded-For")
+
+update_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+update_tasks = set()
+# Диспетчер берёт апдейт из очереди, только когда есть свободный слот: при всплеске
+# очередь заполняется и вебхук отвечает 503. Семафор отдельный от update_slots —
+# тот берут сами обработчики, и общий семафор заблокировал бы их при полной загрузке.
+dispatch_slots = asyncio.Semaphore(MAX_CONCURRENT_UPDATES)
+ready = asyncio.Event()  # состояние загружено — можно обрабатывать апдейты
+
+async def webhook_handler(request):
+    got = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(got, WEBHOOK_SECRET):
+        return web.Response(status=403)
+    try:
+        update = types.Update.de_json(await request.text())
+    except Exception:
+        return web.Response(status=400)
+    if not shards.owns(update):
+        try:
+            await shards.forward(update)
+        except Exception:
+            traceback.print_exc()
+            return web.Response(status=503)  # владелец недоступен — Telegram повторит
+        return web.Response()
+    try:
+        update_queue.put_nowait(update)
+    except asyncio.QueueFull:
+        # Telegram повторит доставку позже
+        return web.Response(status=503)
+    return web.Response()
 
-        if explain:
-            bot.send_message(message.chat.id, f"✍️ {explain}")
+async def health_handler(request):
+    return web.Response(text="ok")
+
+async def ready_handler(request):
+    return web.Response(text="ready") if ready.is_set() else web.Response(status=503, text="starting")
+
+def metrics_allowed(request) -> bool:
+    if METRICS_TOKEN and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return True
+    if any(h in request.headers for h in PROXY_HEADERS):
+        return False
+    try:
+        return ipaddress.ip_address(request.remote).is_private
+    except (TypeError, ValueError):
+        return False
+
+async def metrics_handler(request):
+    if not metrics_allowed(request):
+        return web.Response(status=403)
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+def build_web_app(webhook: bool = True):
+    app = web.Application()
+    if webhook:
+        app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    app.router.add_get("/", health_handler)
+    app.router.add_get("/ready", ready_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    if shards.enabled:
+        shards.transport.add_routes(app)
+    return app
+
+async def process_update(update):
+    try:
+        # в очереди только свои апдейты: маршрутизация уже сделана на входе
+        await AsyncTeleBot.process_new_updates(bot, [update])
+    except Exception:
+        traceback.print_exc()
+    finally:
+        dispatch_slots.release()
+        update_queue.task_done()
+
+async def dispatch_updates():
+    await ready.wait()  # апдейты, принятые до загрузки состояния, ждут в очереди
+    while True:
+        await dispatch_slots.acquire()
+        update = await update_queue.get()
+        task = asyncio.create_task(process_update(update))
+        update_tasks.add(task)
+        task.add_done_callback(update_tasks.discard)
+
+# === Шардирование по user_id ===
+# Несколько машин/процессов делят пользователей: владелец выбирается rendezvous-хэшем
+# от (узел, user_id), поэтому при смене числа узлов переезжает только ~1/N пользователей.
+# Апдейт чужого пользователя пересылается владельцу, его состояние живёт только там.
+# Транспорт — HTTP между машинами (на Fly — приватная сеть .internal) или общая
+# SQLite-очередь для нескольких процессов на одной машине (локальная проверка).
+SHARD_NODES = [n.strip() for n in os.getenv("SHARD_NODES", "").split(",") if n.strip()]
+SHARD_SELF = os.getenv("SHARD_SELF") or os.getenv("FLY_MACHINE_ID", "")
+SHARD_TRANSPORT = os.getenv("SHARD_TRANSPORT", "http")
+SHARD_URL = os.getenv("SHARD_URL", "http://{node}.vm.%s.internal:%d" % (os.getenv("FLY_APP_NAME", "localhost"), PORT))
+SHARD_QUEUE_PATH = os.getenv("SHARD_QUEUE_PATH", "shard_queue.db")
+SHARD_REBALANCE_RETRY = 30  # сек между попытками передать состояние недоступному узлу
+# Сколько после первого сообщения новому владельцу переданные записи пользователя
+# важнее созданных здесь; опоздавшая передача (сосед долго был недоступен) уже устарела
+SHARD_HANDOFF_WINDOW = int(os.getenv("SHARD_HANDOFF_WINDOW", "600"))
+
+if SHARD_NODES and not os.getenv("WEBHOOK_SECRET"):
+    # узлы проверяют пересылки по WEBHOOK_SECRET; случайный секрет у каждого процесса свой
+    raise RuntimeError("WEBHOOK_SECRET must be set when SHARD_NODES is set")
+
+SHARD_USER_TABLES = ("modes", "langs", "merge", "personas", "msg_count", "user_stats")
+SHARD_AGGREGATES = {
+    "stats_totals": lambda old, new: old + new,
+    "daily_messages": lambda old, new: old + new,
+    "daily_unique": lambda old, new: old.merge(new),
+}
+# Пользователь написал новому владельцу раньше, чем пришли его записи: счётчики складываем,
+# остальное берём у прежнего владельца (иначе теряется персона, выданная при первом сообщении)
+SHARD_HANDOFF = {
+    "msg_count": lambda old, new: old + new,
+    "user_stats": max,
+}
+UPDATE_FIELDS = ("message", "edited_message", "callback_query")
+
+def shard_owner(user_id: int, nodes=SHARD_NODES) -> str:
+    return max(nodes, key=lambda node: hashlib.blake2b(f"{node}:{user_id}".encode(), digest_size=8).digest())
+
+def update_user_id(update):
+    for field in UPDATE_FIELDS:
+        obj = getattr(update, field, None)
+        if obj is not None and obj.from_user is not None:
+            return obj.from_user.id
+    return None
+
+def update_json(update) -> dict:
+    body = {"update_id": update.update_id}
+    for field in UPDATE_FIELDS:
+        obj = getattr(update, field, None)
+        if obj is not None:
+            body[field] = obj.json
+    return body
+
+class HttpShardTransport:
+    def __init__(self, url: str, secret: str):
+        self.url = url
+        self.secret = secret
+        self.session = None
+
+    async def send(self, node: str, kind: str, body: dict):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        url = self.url.format(node=node) + f"/shard/{kind}"
+        async with self.session.post(url, json=body, headers={"X-Shard-Secret": self.secret}) as resp:
+            if resp.status != 200:
+                raise RuntimeError(f"shard {node} answered {resp.status}")
+
+    async def handler(self, request):
+        if not hmac.compare_digest(request.headers.get("X-Shard-Secret", ""), self.secret):
+            return web.Response(status=403)
+        try:
+            await shards.receive(request.match_info["kind"], await request.json())
+        except asyncio.QueueFull:
+            return web.Response(status=503)
+        return web.Response()
+
+    def add_routes(self, app):
+        app.router.add_post("/shard/{kind}", self.handler)
+
+    async def run(self):
+        pass  # входящие приходят через web-приложение
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+class SqliteShardQueue:
+    """Очередь в общем файле SQLite: стенд из нескольких процессов без сети."""
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "node TEXT NOT NULL, kind TEXT NOT NULL, body TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    def _put(self, node: str, kind: str, body: str):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO queue (node, kind, body) VALUES (?, ?, ?)", (node, kind, body))
+
+    def _take(self, node: str, limit: int = 100) -> list:
+        with self.lock, self.conn:
+            rows = self.conn.execute(
+                "SELECT id, kind, body FROM queue WHERE node = ? ORDER BY id LIMIT ?", (node, limit)
+            ).fetchall()
+            if rows:
+                self.conn.execute("DELETE FROM queue WHERE node = ? AND id <= ?", (node, rows[-1][0]))
+        return rows
+
+    async def send(self, node: str, kind: str, body: dict):
+        await asyncio.to_thread(self._put, node, kind, json.dumps(body, ensure_ascii=False))
 
-        inc_and_maybe_remind(message.chat.id, message.from_user.id)
+    def add_routes(self, app):
+        pass
+
+    async def run(self):
+        while True:
+            rows = await asyncio.to_thread(self._take, SHARD_SELF)
+            for _, kind, body in rows:
+                try:
+                    await shards.receive(kind, json.loads(body))
+                except Exception:
+                    traceback.print_exc()
+            if not rows:
+                await asyncio.sleep(0.05)
+
+    async def close(self):
+        pass
+
+SHARD_TRANSPORTS = {
+    "http": lambda: HttpShardTransport(SHARD_URL, WEBHOOK_SECRET),
+    "sqlite": lambda: SqliteShardQueue(SHARD_QUEUE_PATH),
+}
+
+class Shards:
+    def __init__(self, nodes: list, me: str):
+        self.nodes = nodes
+        self.me = me
+        self.enabled = bool(nodes)
+        self.transport = SHARD_TRANSPORTS[SHARD_TRANSPORT]() if self.enabled else None
+        self.forwarded = 0
+        self.received = 0
+        self.failed = 0
+        self.moved = 0
+        self.fresh = OrderedDict()  # user_id -> когда состояние появилось здесь (по возрастанию)
+
+    def note_new_user(self, user_id: int):
+        now = time.monotonic()
+        self.fresh[user_id] = now
+        # окно передачи давно закрыто — старые записи выкидываем с головы
+        while self.fresh and now - next(iter(self.fresh.values())) > SHARD_HANDOFF_WINDOW:
+            self.fresh.popitem(last=False)
+
+    def is_fresh(self, user_id) -> bool:
+        added = self.fresh.get(user_id)
+        return added is not None and time.monotonic() - added <= SHARD_HANDOFF_WINDOW
+
+    @property
+    def leader(self) -> bool:
+        # long polling у бота может быть только один — его ведёт первый узел
+        return not self.enabled or self.me == self.nodes[0]
+
+    def owns(self, update) -> bool:
+        if not self.enabled:
+            return True
+        user_id = update_user_id(update)
+        return user_id is None or shard_owner(user_id, self.nodes) == self.me
+
+    async def forward(self, update):
+        node = shard_owner(update_user_id(update), self.nodes)
+        await self.transport.send(node, "update", update_json(update))
+        self.forwarded += 1
+
+    async def receive(self, kind: str, body: dict):
+        await ready.wait()  # иначе загрузка состояния перезапишет переданные записи
+        self.received += 1
+        if kind == "update":
+            # пришедший от соседа апдейт уже у владельца — обрабатываем здесь, без повторной маршрутизации
+            update_queue.put_nowait(types.Update.de_json(body))
+        elif kind == "state":
+            merge_state(body)
+
+    async def rebalance(self):
+        # раздаём владельцам записи пользователей, которые теперь не наши;
+        # если узла нет в SHARD_NODES (машину выводят), отдаём и агрегаты статистики
+        await ready.wait()
+        pending = True
+        while pending:
+            pending = False
+            batches = defaultdict(lambda: defaultdict(dict))
+            for table in SHARD_USER_TABLES:
+                target, _, encode, _ = STATE_TABLES[table]
+                for key in list(target):
+                    owner = shard_owner(key, self.nodes)
+                    if owner != self.me:
+                        batches[owner][table][str(key)] = json.dumps(encode(target[key]), ensure_ascii=False)
+            if self.me not in self.nodes:
+                for table in SHARD_AGGREGATES:
+                    target, _, encode, _ = STATE_TABLES[table]
+                    for key in list(target):
+                        batches[self.nodes[0]][table][str(key)] = json.dumps(encode(target[key]), ensure_ascii=False)
+            for node, tables in batches.items():
+                try:
+                    await self.transport.send(node, "state", tables)
+                except Exception as e:
+                    print(f"⚠️ Shard handoff to {node} failed: {e}")
+                    pending = True
+                    continue
+                for table, rows in tables.items():
+                    target, key_type, _, _ = STATE_TABLES[table]
+                    for key in rows:
+                        target.pop(key_type(key), None)
+                        state.mark(table, key_type(key))
+                        self.moved += 1
+            if pending:
+                await asyncio.sleep(SHARD_REBALANCE_RETRY)
+
+    async def route(self, updates):
+        local = []
+        for update in updates:
+            if self.owns(update):
+                local.append(update)
+                continue
+            try:
+                await self.forward(update)
+            except Exception:
+                # владелец недоступен: лучше ответить отсюда, чем потерять сообщение
+                self.failed += 1
+                traceback.print_exc()
+                local.append(update)
+        if local:
+            await AsyncTeleBot.process_new_updates(bot, local)
+
+    def format_stats(self) -> str:
+        if not self.enabled:
+            return "• Shard: single node"
+        return (
+            f"• Shard: {self.me} of {len(self.nodes)}, forwarded {self.forwarded}, received {self.received}, "
+            f"forward failed {self.failed}, handed off {self.moved}"
+        )
+
+def merge_state(tables: dict):
+    for table, rows in tables.items():
+        if table not in STATE_TABLES:
+            continue
+        target, key_type, _, decode = STATE_TABLES[table]
+        combine = SHARD_AGGREGATES.get(table)
+        for key, value in rows.items():
+            key, value = key_type(key), decode(json.loads(value))
+            if key in target:
+                if table in SHARD_USER_TABLES and shards.is_fresh(key):
+                    # запись создана здесь, пока переданные ещё были в пути — берём переданную
+                    if table in SHARD_HANDOFF:
+                        value = SHARD_HANDOFF[table](target[key], value)
+                elif combine is None:
+                    continue  # у владельца уже есть более свежая запись
+                else:
+                    value = combine(target[key], value)
+            target[key] = value
+            state.mark(table, key)
+
+shards = Shards(SHARD_NODES, SHARD_SELF)
+if shards.enabled:
+    # лимиты OpenAI и Telegram общие на аккаунт и токен — делим между узлами
+    share = len(SHARD_NODES)
+    scheduler.global_bucket = TokenBucket(OPENAI_GLOBAL_RPM / share, max(1.0, OPENAI_GLOBAL_RPM / 60 / share))
+    outbox.global_bucket = TokenBucket(OUTBOX_GLOBAL_PER_SEC * 60 / share, max(1.0, OUTBOX_GLOBAL_PER_SEC / share))
+    # polling отдаёт апдейты сюда; вебхук маршрутизирует сам в webhook_handler
+    bot.process_new_updates = shards.route
+
+async def start_web_server(webhook: bool):
+    runner = web.AppRunner(build_web_app(webhook))
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    return runner
+
+async def wait_for_stop():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+async def drain_updates():
+    try:
+        await asyncio.wait_for(update_queue.join(), WEBHOOK_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"⚠️ Update queue not drained: {update_queue.qsize()} updates left")
 
+async def run_webhook():
+    runner = await start_web_server(webhook=True)
+    await tg.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    try:
+        await wait_for_stop()
+    finally:
+        await runner.cleanup()
+        await state.flush()  # до ожидания очереди: машину могут убить раньше, чем она опустеет
+        await drain_updates()
+        await bot.close_session()
+
+async def run_polling():
+    runner = None
+    if SERVE_METRICS or shards.enabled:
+        # в режиме polling HTTP нужен только для /, /metrics и /shard
+        runner = await start_web_server(webhook=False)
+    try:
+        if shards.leader:
+            await tg.remove_webhook()
+            await ready.wait()  # polling обрабатывает апдейты сам, мимо очереди
+            await bot.polling(non_stop=True)
+        else:
+            # остальные узлы получают апдейты только от ведущего
+            await wait_for_stop()
+            await state.flush()
+            await drain_updates()
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+# === Старт ===
+# При FAST_START порт начинает слушаться сразу: вебхук принимает апдейты в очередь,
+# пока состояние читается из SQLite в отдельном потоке, а импорт openai и соединения
+# с Telegram и OpenAI прогреваются в фоне. Готовность видна на /ready.
+BOOT_STARTED = time.monotonic()
+
+async def load_state():
+    try:
+        await asyncio.to_thread(state.load)
+        migrate_stats()
     except Exception:
-        bot.send_message(message.chat.id, t(lang, "err_text"))
+        # без состояния ready не наступит и апдейты будут копиться в очереди вечно —
+        # лучше упасть сразу, чтобы Fly перезапустил машину
         traceback.print_exc()
+        print("❌ State load failed, exiting", flush=True)
+        os._exit(1)
+    ready.set()
+    print(f"✅ Ready in {time.monotonic() - BOOT_STARTED:.2f}s")
 
-print("🤖 Bot läuft...")
-bot.polling(none_stop=True)
+async def warm_up():
+    try:
+        if isinstance(client, Lazy):
+            await asyncio.to_thread(importlib.import_module, "openai")
+        # первый запрос открывает TLS-соединения в пулах, ответ не нужен
+        await asyncio.gather(client.models.list(), tg.get_me(), return_exceptions=True)
+    except Exception:
+        traceback.print_exc()
+
+async def main():
+    background = [asyncio.create_task(state.run())]
+    if FAST_START:
+        background.append(asyncio.create_task(load_state()))
+        background.append(asyncio.create_task(warm_up()))
+    else:
+        await load_state()
+    if WEBHOOK_URL or shards.enabled:
+        background.append(asyncio.create_task(dispatch_updates()))
+    if shards.enabled:
+        background.append(asyncio.create_task(shards.transport.run()))
+        background.append(asyncio.create_task(shards.rebalance()))
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        cancel_tasks(*background)
+        if shards.enabled:
+            await shards.transport.close()
+        await state.flush()
+
+if __name__ == "__main__":
+    print("🤖 Bot läuft...")
+    asyncio.run(main())
@@ -0,0 +1,7 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ["STATE_BACKEND"] = "memory"
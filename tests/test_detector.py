@@ -0,0 +1,41 @@
+import pytest
+
+import main
+
+@pytest.mark.parametrize("text", [
+    "I was born in Germany",
+    "Ich wohne in Germany",
+    "What does your dog eat?",
+    "я говорю по-немецки плохо",
+    "ты говоришь по-немецки?",
+    "translated yesterday",
+    "Ты смотрел фильм «Титаник»?",
+    "Ты был в «Эрмитаже»?",
+])
+def test_broad_phrases_are_not_confident_yes(text):
+    assert main.classify_translation_request(text) is not True
+
+@pytest.mark.parametrize("text", [
+    "Hallo", "Danke", "ok", "yes", "Привет!", "спасибо", "Guten Morgen", "tamam", "شكرا", "👍",
+])
+def test_small_talk_is_local_no(text):
+    assert main.classify_translation_request(text) is False
+
+@pytest.mark.parametrize("text", [
+    "как сказать собака",
+    "Wie sagt man dog?",
+    "How do you say dog in German?",
+    "كيف أقول كلب",
+    "собака по-немецки?",
+    "what does 'Feierabend' mean?",
+])
+def test_translation_requests_are_local_yes(text):
+    assert main.classify_translation_request(text) is True
+
+def test_german_sentence_is_local_no():
+    assert main.classify_translation_request("Ich habe heute Pizza gegessen") is False
+
+def test_triggers_match_whole_words_only():
+    assert main.has_translation_trigger("please translate this")
+    assert not main.has_translation_trigger("I translated it yesterday")
+    assert not main.has_translation_trigger("I was born in Germany")
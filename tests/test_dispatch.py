@@ -0,0 +1,38 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+def test_dispatcher_leaves_backlog_in_bounded_queue(monkeypatch):
+    async def scenario():
+        release = asyncio.Event()
+        started = []
+
+        async def process_new_updates(bot, updates):
+            started.extend(updates)
+            await release.wait()
+
+        monkeypatch.setattr(main, "AsyncTeleBot", SimpleNamespace(process_new_updates=process_new_updates))
+        monkeypatch.setattr(main, "update_queue", asyncio.Queue(maxsize=3))
+        monkeypatch.setattr(main, "dispatch_slots", asyncio.Semaphore(2))
+        monkeypatch.setattr(main, "ready", asyncio.Event())
+        main.ready.set()
+
+        dispatcher = asyncio.create_task(main.dispatch_updates())
+        for n in range(5):
+            main.update_queue.put_nowait(n)
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.01)
+        assert started == [0, 1]  # заняты оба слота, остальное ждёт в очереди
+        assert main.update_queue.qsize() == 3
+        with pytest.raises(asyncio.QueueFull):
+            main.update_queue.put_nowait(5)  # вебхук ответит 503
+
+        release.set()
+        await asyncio.wait_for(main.update_queue.join(), 1)
+        assert started == [0, 1, 2, 3, 4]
+        dispatcher.cancel()
+
+    asyncio.run(scenario())
@@ -0,0 +1,29 @@
+import pytest
+
+import main
+
+@pytest.mark.parametrize("n", [10, 1000, 50000])
+def test_estimate_error(n):
+    hll = main.HyperLogLog()
+    for user_id in range(n):
+        hll.add(user_id)
+        hll.add(user_id)  # повторы не считаются
+    # стандартная ошибка 1.04/sqrt(4096) ≈ 1.6%, берём три сигмы
+    assert len(hll) == pytest.approx(n, rel=0.05, abs=1)
+
+def test_merge_estimates_union():
+    a, b = main.HyperLogLog(), main.HyperLogLog()
+    for user_id in range(0, 30000):
+        a.add(user_id)
+    for user_id in range(20000, 50000):
+        b.add(user_id)
+    union = main.HyperLogLog(bytes(a.registers)).merge(b)
+    assert len(union) == pytest.approx(50000, rel=0.05)
+    assert len(union.merge(a)) == len(union)  # повторное слияние ничего не меняет
+
+def test_registers_round_trip():
+    hll = main.HyperLogLog()
+    for user_id in range(-500, 500):
+        hll.add(user_id)
+    assert len(main.HyperLogLog(bytes(hll.registers))) == len(hll)
+    assert len(main.HyperLogLog()) == 0
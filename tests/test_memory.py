@@ -0,0 +1,19 @@
+import main
+
+def test_history_is_append_only_between_folds(monkeypatch):
+    monkeypatch.setattr(main, "MEMORY_TURNS", 6)
+    monkeypatch.setattr(main, "MEMORY_TOKEN_BUDGET", 10000)
+    memory = main.ConversationMemory()
+    conv = memory.get(1)
+    conv.summarizing = True  # резюме не запускаем — проверяем только окно реплик
+    prefixes = []
+    for n in range(12):
+        memory.remember(1, f"frage {n}", f"antwort {n}")
+        prefixes.append(memory.context(1))
+    folds = 0
+    for before, after in zip(prefixes, prefixes[1:]):
+        if after[:len(before)] != before:
+            folds += 1
+    assert folds == 2  # на 7-й и 11-й реплике, а не на каждой
+    assert len(conv.turns) == 4
+    assert [u for u, _ in conv.folding][:3] == ["frage 0", "frage 1", "frage 2"]
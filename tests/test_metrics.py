@@ -0,0 +1,28 @@
+import asyncio
+from unittest import mock
+
+from aiohttp.test_utils import make_mocked_request
+
+import main
+
+def request(peer: str, headers=None):
+    transport = mock.Mock()
+    transport.get_extra_info.side_effect = lambda name, default=None: (peer, 40000) if name == "peername" else default
+    return make_mocked_request("GET", "/metrics", headers=headers or {}, transport=transport)
+
+def status(req) -> int:
+    return asyncio.run(main.metrics_handler(req)).status
+
+def test_private_network_scraper_is_allowed():
+    assert status(request("fdaa:0:1::2")) == 200
+    assert status(request("127.0.0.1")) == 200
+
+def test_public_requests_are_rejected():
+    assert status(request("8.8.8.8")) == 403
+    assert status(request("fdaa:0:1::3", {"Fly-Client-IP": "8.8.8.8"})) == 403
+
+def test_token_opens_metrics_through_proxy(monkeypatch):
+    monkeypatch.setattr(main, "METRICS_TOKEN", "s3cret")
+    headers = {"Fly-Client-IP": "8.8.8.8"}
+    assert status(request("fdaa:0:1::3", {**headers, "Authorization": "Bearer s3cret"})) == 200
+    assert status(request("fdaa:0:1::3", {**headers, "Authorization": "Bearer nope"})) == 403
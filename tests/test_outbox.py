@@ -0,0 +1,22 @@
+import asyncio
+
+import main
+
+def test_idle_chats_are_reaped(monkeypatch):
+    monkeypatch.setattr(main, "OUTBOX_CHAT_PER_SEC", 200)
+    monkeypatch.setattr(main, "OUTBOX_GLOBAL_PER_SEC", 10000)
+
+    async def send(chat_id, text):
+        return text
+
+    async def scenario():
+        outbox = main.Outbox()
+        for chat_id in range(50):
+            for n in range(3):
+                assert await outbox.submit(chat_id, send, (chat_id, n), {}) == n
+        await asyncio.sleep(0.1)
+        assert outbox.chats == {}
+        assert outbox.workers == {}
+        assert outbox.sent == 150
+
+    asyncio.run(scenario())
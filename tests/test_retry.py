@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+from telebot import asyncio_helper
+
+import main
+
+def flood():
+    result = {"ok": False, "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": 0.001}}
+    return asyncio_helper.ApiTelegramException("sendMessage", None, result)
+
+def server_error():
+    result = {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+    return asyncio_helper.ApiTelegramException("sendMessage", None, result)
+
+def run_failing(breaker, error, monkeypatch):
+    monkeypatch.setattr(main, "RETRY_MAX_ATTEMPTS", 1)
+
+    async def fail():
+        raise error
+
+    async def call():
+        try:
+            await main.call_with_retry(breaker, main.telegram_retry_after, 5, fail, (), {})
+        except asyncio_helper.ApiTelegramException:
+            pass
+
+    asyncio.run(call())
+
+def test_flood_replies_do_not_open_breaker(monkeypatch):
+    breaker = main.CircuitBreaker("telegram")
+    for _ in range(main.BREAKER_THRESHOLD * 2):
+        run_failing(breaker, flood(), monkeypatch)
+    breaker.before()  # не CircuitOpen
+    assert breaker.trips == 0
+
+def test_server_errors_open_breaker(monkeypatch):
+    breaker = main.CircuitBreaker("telegram")
+    for _ in range(main.BREAKER_THRESHOLD):
+        run_failing(breaker, server_error(), monkeypatch)
+    assert breaker.trips == 1
+    with pytest.raises(main.CircuitOpen):
+        breaker.before()
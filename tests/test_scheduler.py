@@ -0,0 +1,84 @@
+import asyncio
+import time
+from collections import deque
+
+import pytest
+
+import main
+
+def enqueue(sched, user_id, n):
+    loop = asyncio.get_running_loop()
+    futures = [loop.create_future() for _ in range(n)]
+    queue = sched.queues.setdefault(user_id, deque())
+    queue.extend((fut, time.monotonic()) for fut in futures)
+    return futures
+
+def granted(futures) -> int:
+    return sum(fut.done() for fut in futures)
+
+def test_dispatch_serves_users_round_robin():
+    async def scenario():
+        sched = main.FairScheduler()
+        sched.global_bucket = main.TokenBucket(0, 4)
+        heavy = enqueue(sched, 1, 6)
+        light = [enqueue(sched, user_id, 1) for user_id in (2, 3, 4)]
+        sched.dispatch()
+        # один проход — по запросу на каждого, тяжёлый пользователь не выедает общий лимит
+        assert granted(heavy) == 1
+        assert all(granted(f) == 1 for f in light)
+        assert sched.dispatch() == sched.global_bucket.wait_time()
+        assert granted(heavy) == 1
+
+    asyncio.run(scenario())
+
+def test_user_bucket_limits_only_that_user(monkeypatch):
+    monkeypatch.setattr(main, "OPENAI_USER_BURST", 2)
+
+    async def scenario():
+        sched = main.FairScheduler()
+        sched.global_bucket = main.TokenBucket(0, 100)
+        heavy, light = enqueue(sched, 1, 5), enqueue(sched, 2, 2)
+        delays = [sched.dispatch() for _ in range(4)]
+        assert granted(heavy) == 2  # корзина пользователя пуста, остальные ждут её пополнения
+        assert granted(light) == 2
+        assert delays[-1] == pytest.approx(60 / main.OPENAI_USER_RPM, rel=0.01)
+
+    asyncio.run(scenario())
+
+def test_acquire_rejects_when_user_queue_is_full(monkeypatch):
+    monkeypatch.setattr(main, "OPENAI_USER_MAX_QUEUE", 2)
+
+    async def scenario():
+        sched = main.FairScheduler()
+        sched.global_bucket = main.TokenBucket(0, 0)  # ничего не выдаём — очередь только растёт
+        main.current_user.set(7)
+        waiting = [asyncio.create_task(sched.acquire()) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(main.RateLimited):
+            await sched.acquire()
+        assert sched.stats["rejected"] == 1
+        main.current_user.set(8)
+        other = asyncio.create_task(sched.acquire())  # у другого пользователя своя очередь
+        await asyncio.sleep(0)
+        assert not other.done()
+        assert sched.depth() == 3
+        for task in (*waiting, other, sched.runner):
+            task.cancel()
+
+    asyncio.run(scenario())
+
+def test_reap_drops_idle_buckets():
+    async def scenario():
+        sched = main.FairScheduler()
+        sched.global_bucket = main.TokenBucket(0, 20000)
+        for user_id in range(12000):
+            enqueue(sched, user_id, 1)
+        sched.dispatch()
+        waiting = enqueue(sched, 99999, 1)
+        sched.bucket(99999).tokens = 0
+        assert len(sched.user_buckets) == 12001
+        sched.reap(time.monotonic() + 60 / main.OPENAI_USER_RPM * main.OPENAI_USER_BURST)
+        assert list(sched.user_buckets) == [99999]  # у кого есть очередь — корзину держим
+        assert not waiting[0].done()
+
+    asyncio.run(scenario())
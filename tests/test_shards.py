@@ -0,0 +1,55 @@
+import pytest
+
+import main
+
+USERS = range(1, 20001)
+NODES = ["m1", "m2", "m3", "m4"]
+
+def test_adding_node_moves_about_one_nth_of_users():
+    before = {u: main.shard_owner(u, NODES) for u in USERS}
+    after = {u: main.shard_owner(u, NODES + ["m5"]) for u in USERS}
+    moved = [u for u in USERS if before[u] != after[u]]
+    assert all(after[u] == "m5" for u in moved)  # переезжают только на новый узел
+    assert len(moved) / len(USERS) == pytest.approx(1 / 5, abs=0.02)
+
+def test_removing_node_moves_only_its_users():
+    before = {u: main.shard_owner(u, NODES) for u in USERS}
+    after = {u: main.shard_owner(u, NODES[:-1]) for u in USERS}
+    assert {u for u in USERS if before[u] != after[u]} == {u for u in USERS if before[u] == "m4"}
+
+def test_owner_is_balanced_and_deterministic():
+    counts = {node: 0 for node in NODES}
+    for u in USERS:
+        counts[main.shard_owner(u, NODES)] += 1
+    assert main.shard_owner(42, NODES) == main.shard_owner(42, list(reversed(NODES)))
+    assert max(counts.values()) / min(counts.values()) < 1.1
+
+def test_handoff_overwrites_rows_created_during_handoff(monkeypatch):
+    user_id, old_user = 990001, 990002
+    persona, handed_off = main.PERSONAS[0], main.PERSONAS[1]
+    monkeypatch.setitem(main.user_personas, user_id, persona)
+    monkeypatch.setitem(main.user_msg_count, user_id, 2)
+    monkeypatch.setitem(main.user_personas, old_user, persona)
+    monkeypatch.setattr(main.shards, "fresh", main.OrderedDict())
+    main.shards.note_new_user(user_id)
+
+    main.merge_state({
+        "personas": {str(user_id): '"%s"' % handed_off["id"], str(old_user): '"%s"' % handed_off["id"]},
+        "msg_count": {str(user_id): "40"},
+    })
+    assert main.user_personas[user_id] is handed_off
+    assert main.user_msg_count[user_id] == 42
+    assert main.user_personas[old_user] is persona  # загружена при старте — не трогаем
+
+def test_fresh_users_expire_after_handoff_window(monkeypatch):
+    user_id = 990003
+    monkeypatch.setattr(main.shards, "fresh", main.OrderedDict())
+    monkeypatch.setitem(main.user_personas, user_id, main.PERSONAS[0])
+    main.shards.note_new_user(user_id)
+    main.shards.fresh[user_id] -= main.SHARD_HANDOFF_WINDOW + 1  # первое сообщение было давно
+
+    main.merge_state({"personas": {str(user_id): '"%s"' % main.PERSONAS[1]["id"]}})
+    assert main.user_personas[user_id] is main.PERSONAS[0]  # поздняя передача не перетирает
+
+    main.shards.note_new_user(990004)
+    assert list(main.shards.fresh) == [990004]
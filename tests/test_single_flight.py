@@ -0,0 +1,40 @@
+import asyncio
+
+import main
+
+def test_waiters_share_one_call():
+    calls = []
+
+    async def work(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        return x * 2
+
+    async def scenario():
+        flight = main.SingleFlight("test")
+        results = await asyncio.gather(*(flight.do("k", work, 21) for _ in range(3)))
+        assert results == [42, 42, 42]
+        assert calls == [21]
+        assert flight.shared == 2
+
+    asyncio.run(scenario())
+
+def test_leader_rate_limit_is_not_shared():
+    async def work(user_id):
+        await asyncio.sleep(0.01)
+        if main.current_user.get() == 1:  # переполнена очередь только у первого
+            raise main.RateLimited(1)
+        return "ok"
+
+    async def call(user_id, flight):
+        main.current_user.set(user_id)
+        try:
+            return await flight.do("k", work, user_id)
+        except main.RateLimited:
+            return "limited"
+
+    async def scenario():
+        flight = main.SingleFlight("test")
+        assert await asyncio.gather(call(1, flight), call(2, flight)) == ["limited", "ok"]
+
+    asyncio.run(scenario())
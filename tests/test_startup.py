@@ -0,0 +1,21 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import main
+
+def test_failed_state_load_exits(monkeypatch):
+    def broken_load():
+        raise sqlite3.DatabaseError("database disk image is malformed")
+
+    def exit_(code):
+        raise SystemExit(code)
+
+    monkeypatch.setattr(main.state, "load", broken_load)
+    monkeypatch.setattr(main.os, "_exit", exit_)
+    monkeypatch.setattr(main, "ready", asyncio.Event())
+    with pytest.raises(SystemExit) as exc:
+        asyncio.run(main.load_state())
+    assert exc.value.code == 1
+    assert not main.ready.is_set()
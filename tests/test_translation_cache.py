@@ -0,0 +1,22 @@
+import main
+
+ORDER = "how to say I would like to order a coffee with milk please"
+
+def test_exact_only_by_default():
+    cache = main.TranslationCache(10, 3600, main.TRANSLATION_CACHE_SIMILARITY)
+    cache.put(ORDER, "en", "Ich hätte gern einen Kaffee mit Milch.")
+    assert cache.get("How to say: I would like to order a coffee with milk, please!", "en")
+    assert cache.get("how to say I would like to order a coffe with milk please", "en") is None
+    assert cache.get(ORDER, "de") is None
+
+def test_near_match_tolerates_typos():
+    cache = main.TranslationCache(10, 3600, 0.7)
+    cache.put(ORDER, "en", "mit Milch")
+    assert cache.get("how to say I would like to order a coffe with milk please", "en") == "mit Milch"
+    assert cache.near_hits == 1
+
+def test_near_match_requires_same_words():
+    cache = main.TranslationCache(10, 3600, 0.7)
+    cache.put(ORDER, "en", "mit Milch")
+    assert cache.get("how to say I would like to order a coffee without milk please", "en") is None
+    assert cache.get("how to say I would like to order a coffee with silk please", "en") is None
@@ -0,0 +1,29 @@
+import asyncio
+
+import main
+
+def test_put_get_and_evict(tmp_path):
+    async def scenario():
+        cache = main.TtsCache(str(tmp_path), 10)
+        await cache.put("a", b"123456")
+        await cache.remember_file_id("a", "file-a")
+        assert await cache.get("a") == b"123456"
+        assert await cache.file_id("a") == "file-a"
+        await cache.put("b", b"abcdef")  # 12 байт > 10: вытесняется "a" вместе с file_id
+        assert list(cache.entries) == ["b"]
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["b.audio"]
+        assert await cache.get("a") is None
+        await cache.forget_file_id("b")
+        assert await cache.file_id("b") is None
+
+    asyncio.run(scenario())
+
+def test_missing_file_is_dropped(tmp_path):
+    async def scenario():
+        cache = main.TtsCache(str(tmp_path), 100)
+        await cache.put("a", b"data")
+        (tmp_path / "a.audio").unlink()
+        assert await cache.get("a") is None
+        assert cache.entries == {} and cache.total == 0
+
+    asyncio.run(scenario())
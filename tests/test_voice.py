@@ -0,0 +1,34 @@
+import asyncio
+import shutil
+import tempfile
+
+import pytest
+
+import main
+
+@pytest.fixture
+def broken_ffmpeg(monkeypatch):
+    monkeypatch.setattr(main, "FFMPEG", shutil.which("false"))  # процесс завершается с ошибкой
+
+def spooled(data: bytes):
+    audio = tempfile.SpooledTemporaryFile(max_size=16)
+    audio.write(data)
+    return audio
+
+def test_failed_truncation_rejects_and_closes(broken_ffmpeg):
+    audio = spooled(b"x" * 64)
+    truncated = main.voice_stats["truncated"]
+    with pytest.raises(main.VoiceTooLong):
+        asyncio.run(main.preprocess_voice(audio, main.VOICE_MAX_SECONDS))
+    assert audio.closed
+    assert main.voice_stats["truncated"] == truncated
+
+def test_failed_trim_without_limit_sends_original(broken_ffmpeg):
+    audio = spooled(b"x" * 64)
+    assert asyncio.run(main.preprocess_voice(audio)) is audio
+    assert not audio.closed
+    audio.close()
+
+def test_voice_limit():
+    assert main.voice_limit(10) is None
+    assert main.voice_limit(main.VOICE_REJECT_SECONDS + 1) == "reject"